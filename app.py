@@ -1,9 +1,10 @@
 from database import DB
 from dash_app import App
+from jobs import job_queue
 print("Hello world")
 
 db_client = DB()
-app = App(db_client)
+app = App(db_client, queue=job_queue())
 server = app.app.server 
 
 if __name__=="__main__":
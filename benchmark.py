@@ -0,0 +1,254 @@
+#!/bin/env python3
+""" Benchmarks of the ingest, generation, load shape and privacy hot paths on synthetic meters.
+
+	python benchmark.py --scales 1000 10000 --output bench.json
+	python benchmark.py --scales 1000 10000 --compare bench.json
+
+Runs against a throwaway SQLite file unless --database-url (e.g. a scratch PostgreSQL) is given; every table
+the loader owns is dropped and rebuilt there. Reports wall time, peak RSS and DB round trips per step as JSON.
+Peak RSS is sampled every 10ms during each step, summed over this process and its children (e.g. pool workers),
+so pages shared with forked workers count more than once. Round trips are counted on this process's engines, so
+work done in pool workers is not included in them: load_data's count leaves out the grid precompute and, on
+PostgreSQL, the population generation.
+No data version is written, so load shapes are computed rather than served from the caches.
+"""
+import os
+import sys
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import flask
+import psutil
+import numpy as np
+import pandas as pd
+import simplejson as json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+round_trips = [0]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_round_trip(conn, cursor, statement, parameters, context, executemany):
+	round_trips[0] += 1
+
+
+def rss_mb(process):
+	rss = process.memory_info().rss
+	for child in process.children(recursive=True):
+		try:
+			rss += child.memory_info().rss
+		except psutil.Error:
+			# exited since it was listed
+			pass
+	return rss / 1024**2
+
+
+def sample_peak_rss(process, peak, stop, interval=0.01):
+	while True:
+		peak[0] = max(peak[0], rss_mb(process))
+		if stop.wait(interval):
+			return
+
+
+class Timer:
+	def __init__(self, scale):
+		self.scale = scale
+		self.results = []
+
+	def run(self, step, func, *args, **kwargs):
+		# ru_maxrss never goes down, so the peak of each step is sampled while it runs
+		process = psutil.Process()
+		start_rss = rss_mb(process)
+		peak, stop = [start_rss], threading.Event()
+		sampler = threading.Thread(target=sample_peak_rss, args=(process, peak, stop), daemon=True)
+		sampler.start()
+		start_trips = round_trips[0]
+		start = time.perf_counter()
+		try:
+			value = func(*args, **kwargs)
+		finally:
+			wall = time.perf_counter() - start
+			stop.set()
+			sampler.join()
+		self.results.append({
+			'scale': self.scale,
+			'step': step,
+			'wall_s': wall,
+			'start_rss_mb': start_rss,
+			'peak_rss_mb': max(peak[0], rss_mb(process)),
+			'db_round_trips': round_trips[0] - start_trips,
+			})
+		print(f"{self.scale:>9} {step:<45} {self.results[-1]['wall_s']:9.3f}s", file=sys.stderr)
+		return value
+
+
+def write_meters(path, n_meters, days, seed=0):
+	""" Write an hourly time series CSV for `n_meters` synthetic meters over `days` days. """
+	rng = np.random.default_rng(seed)
+	datetimes = pd.date_range('2018-01-01', periods=days * 24, freq='H')
+	profile = 1 + 0.5 * np.sin((datetimes.hour.values - 6) / 24 * 2 * np.pi)
+	header = True
+	for start in range(0, n_meters, 1000):
+		meter_ids = np.arange(start, min(start + 1000, n_meters))
+		scale = rng.lognormal(0, 0.5, size=(len(meter_ids), 1))
+		values = scale * profile * rng.lognormal(0, 0.3, size=(len(meter_ids), len(datetimes)))
+		pd.DataFrame({
+			'datetime': np.tile(datetimes.values, len(meter_ids)),
+			'meter_id': np.repeat([f"m{i}" for i in meter_ids], len(datetimes)),
+			'electricity_kwh': values.ravel(),
+			}).to_csv(path, mode='w' if header else 'a', header=header, index=False)
+		header = False
+
+
+def write_populations(path, label, n_meters):
+	config = {
+		'label': label,
+		'rescale': True,
+		'n_meters': n_meters,
+		'metadata_filters': [],
+		'random_seed': 1,
+		'scaling': {'lognormal_mean': 1.5, 'lognormal_sigma': 0.6, 'gaussian_mean': 0, 'gaussian_sigma': 1},
+		}
+	with open(path, 'w') as f:
+		json.dump({'populations': [config]}, f)
+	return config
+
+
+def callback_args(population):
+	""" Arguments to call each App.react callback with, by function name. """
+	summary = {}
+	return {
+		'update_population_summary': lambda: (population, [], 24, 0),
+		'update_fifteen_fifteen': lambda: (summary['value'],),
+		'avg_usage': lambda: (summary['value'],),
+		'poll': lambda: (1, 0, [], None, None, 1000, 0.6, 1),
+		'toggle_quantiles': lambda: ([],),
+		'display_page': lambda: ('/',),
+		'update_usage_histogram': lambda: (summary['value'],),
+		'update_epsilon_noise_graph': lambda: (summary['value'],),
+		'update_uncertainty_value': lambda: (0.2, population, [], 24, 0),
+		'update_recommended_epsilon': lambda: (1, 1),
+		'update_load_status': lambda: (1,),
+		}, summary
+
+
+def benchmark_scale(scale, days, work_dir):
+	from database import DB, load_data
+	from population import Population, PlottingPopulation, load_population_matrix
+	from privacy import PrivateLoadShape
+	from dash_app import App
+
+	timer = Timer(scale)
+	csv_path = os.path.join(work_dir, f"meters_{scale}.csv")
+	populations_path = os.path.join(work_dir, f"populations_{scale}.json")
+	label = f"bench_{scale}"
+	write_meters(csv_path, scale, days)
+	config = write_populations(populations_path, label, scale)
+
+	timer.run('load_data', load_data, csv_path, 'electricity_kwh', 'datetime', 'meter_id', populations_path)
+	db = DB()
+
+	pop = Population(db, f"{label}_generate", config['rescale'], config['n_meters'], config['scaling'], random_seed=1)
+	timer.run('Population.generate', pop.generate)
+	db.delete_population(pop.label)
+
+	plotting = PlottingPopulation(db, label, [], n_points=24, quantile_cutoff=0)
+	ls = timer.run('PlottingPopulation.load_shape', plotting.load_shape)
+	meter_ids, values = load_population_matrix(db, label)
+	df = pd.DataFrame({
+		'meter_id': np.repeat(meter_ids, values.shape[1]),
+		'hour': np.tile(np.arange(values.shape[1]), len(values)),
+		'value': values.ravel(),
+		}).dropna()
+	timer.run('PrivateLoadShape.__init__', PrivateLoadShape, df, index_column='meter_id', time_column='hour',
+		value_column='value', quantile_cutoff_lower=0, quantile_cutoff_upper=1)
+	timer.run('PrivateLoadShape.from_matrix', PrivateLoadShape.from_matrix, values, meter_ids,
+		quantile_cutoff_lower=0, quantile_cutoff_upper=1)
+	timer.run('PrivateLoadShape.privatize', ls.privatize, 1.0)
+	timer.run('PlottingPopulation.epsilon_uncertainty_mapping', plotting.epsilon_uncertainty_mapping)
+
+	app = App(db)
+	args, summary = callback_args(label)
+	callbacks = {}
+	for spec in app.app.callback_map.values():
+		func = getattr(spec['callback'], '__wrapped__', spec['callback'])
+		callbacks[func.__name__] = func
+	# callbacks may read dash.callback_context, which needs a request
+	with app.app.server.test_request_context():
+		flask.g.triggered_inputs = [{'prop_id': 'trigger.n_intervals', 'value': 1}]
+		# the summary feeds the callbacks reading data_store, so it runs first
+		for name in sorted(callbacks, key=lambda n: n != 'update_population_summary'):
+			if name not in args:
+				print(f"No arguments for callback {name}, skipping", file=sys.stderr)
+				continue
+			value = timer.run(f"callback.{name}", callbacks[name], *args[name]())
+			if name == 'update_population_summary':
+				summary['value'] = value
+	return timer.results
+
+
+def compare(results, baseline, threshold, min_seconds):
+	""" Print the change in wall time of each step against `baseline`; returns the steps slower by more than `threshold`,
+	ignoring steps which take under `min_seconds` either way, where timer noise dominates. """
+	before = {(r['scale'], r['step']): r for r in baseline['results']}
+	regressions = []
+	for r in results:
+		b = before.get((r['scale'], r['step']))
+		if b is None or b['wall_s'] <= 0:
+			continue
+		ratio = r['wall_s'] / b['wall_s']
+		flag = ''
+		if ratio > 1 + threshold and max(r['wall_s'], b['wall_s']) >= min_seconds:
+			flag = '  REGRESSION'
+			regressions.append(r)
+		print(f"{r['scale']:>9} {r['step']:<45} {b['wall_s']:9.3f}s -> {r['wall_s']:9.3f}s  x{ratio:.2f}{flag}", file=sys.stderr)
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+		help='numbers of synthetic meters, e.g. 1000 10000 100000 1000000')
+	parser.add_argument('--days', type=int, default=7, help='days of hourly readings per meter')
+	parser.add_argument('--database-url', help='database to run against (default: a temporary SQLite file)')
+	parser.add_argument('--output', help='write the results here as JSON (default: stdout)')
+	parser.add_argument('--compare', help='baseline JSON from an earlier run to compare against')
+	parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio over the baseline reported as a regression')
+	parser.add_argument('--min-seconds', type=float, default=0.01, help='steps faster than this are never reported as regressions')
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(work_dir, 'benchmark.sqlite')}"
+		from database import DB
+		results = []
+		for scale in args.scales:
+			results += benchmark_scale(scale, args.days, work_dir)
+		report = {
+			'meta': {
+				'database': DB().engine.dialect.name,
+				'days': args.days,
+				'python': platform.python_version(),
+				'platform': platform.platform(),
+				'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				},
+			'results': results,
+			}
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
+
+	if args.compare:
+		with open(args.compare) as f:
+			regressions = compare(results, json.load(f), args.threshold, args.min_seconds)
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -3,9 +3,13 @@ import hashlib
 import os
 import shutil
 import logging
+import sys
+import threading
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import simplejson as json
+from metrics import span
 
 logger = logging.getLogger(__name__)
 
@@ -23,19 +27,139 @@ def mkdirs(path):
     return path
 
 
+def approximate_size(obj):
+    """ Best-effort size in bytes of a cached value. """
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, tuple):
+        return sum(approximate_size(o) for o in obj)
+    return sys.getsizeof(obj)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MemoryCache(object):
+    """ Thread-safe, in-process LRU cache bounded by the approximate byte size of its values.
+
+    Concurrent `get` calls for a key which is already being computed wait for that single
+    computation instead of repeating it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        """ Return the cached value for `key`, or None, without computing it. """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def get(self, key, func):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            flight = self._flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = func()
+            if flight.value is not None:
+                self.put(key, flight.value)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def put(self, key, value):
+        size = approximate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.n_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                logger.debug(f"Not caching {key}: {size} bytes exceeds cache size")
+                return
+            self._entries[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+
+def entry_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
 class Cacheable(object):
+    """ On-disk cache of computed objects, bounded to `max_bytes` with least-recently-used eviction.
+
+    Keys include `cache_version`, so entries survive restarts until the underlying data changes.
+    Objects passed with a `cls` providing `to_arrays()`/`from_arrays()` are stored as `.npy` files
+    and memory-mapped on read; anything else is pickled.
+    """
+
     cache_dir = None
+    cache_version = None
+    stats = {"hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+    _stats_lock = threading.Lock()
 
-    def __init__(self, cache_location=".", cache_name=".cache_recurve"):
+    def __init__(self, cache_location=".", cache_name=".cache_recurve", max_bytes=None):
         cache_dir = os.path.join(cache_location, cache_name)
         logging.debug(f"Initializing cache at {cache_dir}")        
         mkdirs(cache_dir)
         self.cache_dir = cache_dir
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("CACHE_MAX_BYTES", 2 * 1024**3))
+        self.max_bytes = max_bytes
 
     def _fail_if_not_init(self):
         if self.cache_dir is None:
             raise ValueError("Please call Cacheable.__init__() to initialize cache")
 
+    def _count(self, stat):
+        with Cacheable._stats_lock:
+            Cacheable.stats[stat] += 1
+
     def clear_cache(self):
         self._fail_if_not_init()
         if os.path.exists(self.cache_dir):
@@ -46,18 +170,90 @@ class Cacheable(object):
         return mkdirs(os.path.join(self.cache_dir, path))
 
     def make_cache_key(self, object_to_serialize):
-        """ Convert an object to a 16-bit string digest representation."""
-        return digest(object_to_serialize)
+        """ Convert an object and the cache version to a 16-bit string digest representation."""
+        return digest([self.cache_version, object_to_serialize])
+
+    def cache_func(self, func, key, cls=None):
+        with span("Cacheable.cache_func") as labels:
+            if self.cache_version is None:
+                # unversioned data may change underneath us, so it is never persisted
+                labels["outcome"] = "unversioned"
+                return func()
+
+            path = self._cache_path(key)
+            if os.path.exists(path):
+                try:
+                    obj = self._read(path, cls)
+                    os.utime(path)
+                    self._count("hits")
+                    labels["outcome"] = "hit"
+                    return obj
+                except (OSError, ValueError, EOFError, KeyError, pickle.UnpicklingError) as e:
+                    logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+                    self._count("errors")
+                    remove_entry(path)
 
-    def cache_func(self, func, key):
+            self._count("misses")
+            labels["outcome"] = "miss"
+            obj = func()
+            if obj is None:
+                return obj
+            try:
+                self._write(path, obj, cls)
+                self._evict()
+            except OSError as e:
+                logger.warning(f"Could not write cache entry {path}: {e}")
+                self._count("errors")
+            return obj
+
+    def _read(self, path, cls):
+        if cls is None:
+            with open(os.path.join(path, "object.pkl"), "rb") as f:
+                return pickle.load(f)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {
+            name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in os.listdir(path)
+            if name.endswith(".npy")
+        }
+        return cls.from_arrays(arrays, meta)
+
+    def _write(self, path, obj, cls):
+        # write to a private directory, then rename it into place so readers never see partial entries
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp)
         try:
-        	path = self._cache_path(key)
-        	if not os.path.exists(path):
-        		obj = func()
-        		with open(path, 'wb') as f:
-        			pickle.dump(obj, f)
-        	with open(path, 'rb') as f:
-        		return pickle.load(f)
-        except Exception as e:
-            return func()
+            if cls is None:
+                with open(os.path.join(tmp, "object.pkl"), "wb") as f:
+                    pickle.dump(obj, f)
+            else:
+                arrays, meta = obj.to_arrays()
+                for name, array in arrays.items():
+                    np.save(os.path.join(tmp, f"{name}.npy"), array, allow_pickle=False)
+                with open(os.path.join(tmp, "meta.json"), "w") as f:
+                    json.dump(meta, f)
+            os.rename(tmp, path)
+        except OSError:
+            remove_entry(tmp)
+            if not os.path.exists(path):
+                raise
+            # otherwise another worker stored the same entry first
 
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            remove_entry(entry)
+            total -= size
+            self._count("evictions")
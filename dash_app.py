@@ -14,8 +14,11 @@ from views.about import about_layout
 from pathlib import Path
 from dash.dependencies import Input, Output, State
 from cache import Cacheable
-from population import PlottingPopulation
+from population import PlottingPopulation, usage_histogram_figure, epsilon_noise_figure, adhoc_label, adhoc_config, DEFAULT_ADHOC_SCALING
 from database import load_data
+from metrics import timed, register_endpoint
+from jobs import population_progress
+from redis.exceptions import RedisError
 
 import plotly.express as px
 import pandas as pd 
@@ -24,9 +27,6 @@ import os
 
 import numpy as np
 
-#from rq import Queue
-#from worker import conn
-
 external_stylesheets = [dbc.themes.BOOTSTRAP, "https://codepen.io/chriddyp/pen/bWLwgP.css"]
 container_layout = html.Div(
     [dcc.Location(id="url", refresh=False), html.Div(id="page-content")]
@@ -45,15 +45,15 @@ class App(Cacheable):
         )
 
 
-    def __init__(self, db_client, port=None):
+    def __init__(self, db_client, port=None, queue=None):
         
         self.app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
         self.db_client = db_client
         self.data_loaded = False
-    #    self.queue = Queue(connection=conn)                
+        self.queue = queue
         self.app.layout = self.serve_layout
+        register_endpoint(self.app.server)
         super().__init__()
-        self.clear_cache()
         self.react()
 
 
@@ -68,13 +68,48 @@ class App(Cacheable):
     def n_points_choices(self):    
         return [1,2,4,8,12,24]
 
-    def population_choices(self):
+    def population_choices(self, ttl=10):
         try:
-            return self.db_client.query_df('select distinct population from population')['population'].values            
+            catalog = self.db_client.population_catalog(ttl=ttl)
+            return catalog.index[catalog['status'] == 'ready'].values
         except Exception as e:
             return [" (loading) "]
 
 
+    def load_status(self):
+        """ One line per population which is not ready yet, with the progress of its generation job if jobs are queued. """
+        try:
+            catalog = self.db_client.population_catalog()
+        except Exception:
+            return []
+        pending = catalog[catalog['status'] != 'ready']
+        if len(pending) == 0:
+            return []
+        progress = {}
+        if self.queue is not None:
+            try:
+                progress = population_progress(self.queue, pending.index)
+            except RedisError:
+                # without the job queue, the catalog status alone is still worth showing
+                pass
+        lines = []
+        for label, status in pending['status'].items():
+            done = progress.get(label, {}).get('progress')
+            if status == 'generating' and done is not None:
+                status = f"{status} ({done:.0%})"
+            lines.append(html.Li(f"{label}: {status}"))
+        return [html.Div("Populations in preparation:", className="padded"), html.Ul(lines)]
+
+    def adhoc_choice(self, n_meters, sigma, seed):
+        """ Dropdown option for a population synthesized in memory from the custom population controls,
+        or None if they are out of range (e.g. more than ADHOC_MAX_METERS meters). """
+        scaling = dict(DEFAULT_ADHOC_SCALING, lognormal_sigma=float(sigma))
+        try:
+            label = adhoc_label(n_meters, scaling=scaling, random_seed=seed)
+        except ValueError:
+            return None
+        return {'label': f"Custom: {int(n_meters)} meters, sigma {float(sigma):g}, seed {int(seed)}", 'value': label}
+
     def quantile_cutoff_choices(self):
         return [0,0.01,0.02,0.03,0.04,0.05]
 
@@ -111,16 +146,32 @@ class App(Cacheable):
 
 
         @self.app.callback(
-            Output('fifteen_fifteen', 'children'),
+            Output('data_store', 'data'),
             [
                 Input('population', "value"),    
                 Input('high_outlier', 'value'),    
+                Input('points', "value"), 
                 Input('quantiles', "value"), 
             ]
             )
-        def update_fifteen_fifteen(population, high_outlier, quantile_cutoff):
-            pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=24, quantile_cutoff=quantile_cutoff)
-            return pop.fifteen_fifteen()
+        @timed('callback.update_population_summary')
+        def update_population_summary(population, high_outlier, n_points, quantile_cutoff):
+            with self.db_client.session():
+                pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=24, quantile_cutoff=quantile_cutoff)
+                return pop.summary(n_points=n_points)
+
+
+        @self.app.callback(
+            Output('fifteen_fifteen', 'children'),
+            [
+                Input('data_store', 'data'),
+            ]
+            )
+        @timed('callback.update_fifteen_fifteen')
+        def update_fifteen_fifteen(summary):
+            if not summary or not summary['ready']:
+                return ""
+            return summary['fifteen_fifteen']
            
 
         # @self.app.callback(
@@ -139,34 +190,77 @@ class App(Cacheable):
         @self.app.callback(
             Output('avg_usage', 'children'),
             [
-                Input('population', "value"), 
-                Input('high_outlier', 'value'),       
-                Input('quantiles', "value"), 
+                Input('data_store', 'data'),
             ]
             )
-        def avg_usage(population, high_outlier, quantile_cutoff):
-            pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=24, quantile_cutoff=quantile_cutoff)
-            return f"{pop.avg_usage():.1f}"
+        @timed('callback.avg_usage')
+        def avg_usage(summary):
+            if not summary or not summary['ready']:
+                return ""
+            return f"{summary['avg_usage']:.1f}"
 
         @self.app.callback(
             Output('population', 'options'),
             Output('population', 'value'),
+            Output('catalog_version', 'data'),
             [
-            Input('trigger', 'n_intervals')]
+            Input('trigger', 'n_intervals'),
+            Input('adhoc_add', 'n_clicks')],
+            [
+            State('population', 'options'),
+            State('population', 'value'),
+            State('catalog_version', 'data'),
+            State('adhoc_n_meters', 'value'),
+            State('adhoc_sigma', 'value'),
+            State('adhoc_seed', 'value')]
             )
-        def poll(n_intervals):    
-            choices = self.population_choices()
+        @timed('callback.poll')
+        def poll(n_intervals, n_clicks, options, selected, seen_version, n_meters, sigma, seed):    
+            triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+            adding = 'adhoc_add.n_clicks' in triggered and n_clicks
+            try:
+                version = self.db_client.catalog_version()
+            except Exception:
+                version = None
+            # the regular poll only sends anything when the catalog changed since this page last saw it
+            if not adding and options and version is not None and version == seen_version:
+                return dash.no_update, dash.no_update, dash.no_update
+            choices = self.population_choices(ttl=0 if version != seen_version else 10)
             choices = [{'label': p, 'value': p} for p in choices]
+            # custom populations added earlier in this session stay selectable
+            choices += [o for o in options or [] if adhoc_config(o['value']) is not None]
+            if adding:
+                if not n_meters or sigma is None or seed is None:
+                    return dash.no_update, dash.no_update, dash.no_update
+                choice = self.adhoc_choice(n_meters, sigma, seed)
+                if choice is None:
+                    return dash.no_update, dash.no_update, dash.no_update
+                if choice['value'] not in [c['value'] for c in choices]:
+                    choices.append(choice)
+                return choices, choice['value'], version
             if len(choices) == 0:
-                return choices, dash.no_update       
-            return choices, choices[0]['value']
+                return choices, dash.no_update, version
+            # keep the population the user picked while it is still available
+            if selected in [c['value'] for c in choices]:
+                return choices, dash.no_update, version
+            return choices, choices[0]['value'], version
     
+        @self.app.callback(
+            Output('load_status', 'children'),
+            [
+            Input('trigger', 'n_intervals')]
+            )
+        @timed('callback.update_load_status')
+        def update_load_status(n_intervals):
+            return self.load_status()
+
         @self.app.callback(
             Output("quantiles_container", component_property="style"),
             Output("quantiles", "value"),
             [
                 Input("high_outlier", "value")
             ])
+        @timed('callback.toggle_quantiles')
         def toggle_quantiles(high_outlier):
             if high_outlier:
                 return {'display': 'none'}, 0
@@ -179,6 +273,7 @@ class App(Cacheable):
             Output("page-content", "children"),
             [Input("url", "pathname")],
         )
+        @timed('callback.display_page')
         def display_page(pathname):
             if pathname == "/load-shape":
                 return content_layout(self.logos())
@@ -195,27 +290,24 @@ class App(Cacheable):
             Output('usage_histogram', "figure"),    
             Output('n_meters', 'children'),
             [
-                Input('population', "value"), 
-                Input('high_outlier', 'value'),       
-                Input('quantiles', "value"), 
+                Input('data_store', 'data'),
             ])
-        def update_usage_histogram(population, high_outlier, quantile_cutoff):
-            pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=24, quantile_cutoff=quantile_cutoff)
-            n_meters = pop.n_meters()
-            return pop.graph_usage_histogram(), n_meters
+        @timed('callback.update_usage_histogram')
+        def update_usage_histogram(summary):
+            if not summary or not summary['ready']:
+                return usage_histogram_figure(None), ""
+            return usage_histogram_figure(summary['histogram']), summary['n_meters']
 
         @self.app.callback(
             Output('epsilon_noise', 'figure'),
             [
-                Input('population', "value"),
-                Input('high_outlier', 'value'),        
-                Input('points', "value"), 
-                Input('quantiles', "value"), 
-        
+                Input('data_store', 'data'),
             ])
-        def update_epsilon_noise_graph(population, high_outlier, n_points, quantile_cutoff):
-            pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=n_points, quantile_cutoff=quantile_cutoff)
-            return pop.graph_epsilon_noise()
+        @timed('callback.update_epsilon_noise_graph')
+        def update_epsilon_noise_graph(summary):
+            if not summary or not summary['ready']:
+                return epsilon_noise_figure(None)
+            return epsilon_noise_figure(summary['epsilon_curve'])
             
 
         @self.app.callback(
@@ -230,10 +322,12 @@ class App(Cacheable):
                 Input('points', "value"), 
                 Input('quantiles', "value"), 
             ])
+        @timed('callback.update_uncertainty_value')
         def update_uncertainty_value(uncertainty, population, high_outlier, n_points, quantile_cutoff):            
-            pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=n_points, quantile_cutoff=quantile_cutoff)
-            epsilon = pop.find_epsilon(uncertainty)
-            load_shape_graph = pop.graph_load_shape(epsilon)
+            with self.db_client.session():
+                pop = PlottingPopulation(self.db_client, population=population, high_outlier=high_outlier, n_points=n_points, quantile_cutoff=quantile_cutoff)
+                epsilon = pop.find_epsilon(uncertainty)
+                load_shape_graph = pop.graph_load_shape(epsilon)
             uncertainty_label = f"Noise: +- {round(100*uncertainty)} %;  privacy factor: {epsilon:.1f}"
             return f"{epsilon:.1f} (min)", load_shape_graph, uncertainty_label
           
@@ -244,6 +338,7 @@ class App(Cacheable):
                 Input('data_societal', "value"),        
                 Input('data_risk', "value"),        
             ])
+        @timed('callback.update_recommended_epsilon')
         def update_recommended_epsilon(societal_value, data_risk):
             return self.recommended_epsilon(societal_value, data_risk) + " (max)"
 
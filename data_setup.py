@@ -1,15 +1,22 @@
 #!/bin/env python3
 from cache import Cacheable
+import os
 import hashlib
 import pandas as pd
-from database import load_data, DB
+from database import load_data, file_hash, DB
+from jobs import job_queue, enqueue_load
 db = DB()
+source_path = 'data/nrel/meter_time_series.csv'
+metadata_path = 'data/nrel/meter_metadata.csv'
 
 
 def population_hash():
+	# also covers the source data, since this hash is the version cached results are keyed on
 	with open('populations.json', 'r') as f:
 		text = f.read()
-	return hashlib.sha224(text.encode()).hexdigest()
+	# the metadata file is optional, as in load_source
+	metadata_hash = file_hash(metadata_path) if os.path.exists(metadata_path) else ''
+	return hashlib.sha224((text + source_hash + metadata_hash).encode()).hexdigest()
 
 def populations_have_changed():
 	if not db.table_exists('load_hash'):
@@ -19,9 +26,18 @@ def populations_have_changed():
 	return old_hash != new_hash
 	
 
-if not db.data_loaded() or populations_have_changed():
+# load_data only re-ingests the CSV if it changed, and only regenerates populations whose config changed
+source_hash = file_hash(source_path)
+queue = job_queue()
+if queue is not None and (not db.data_loaded() or populations_have_changed()):
+	# with REDIS_URL set, loading runs as jobs on `python worker.py` workers
+	enqueue_load(queue, source_path, 'electricity_kwh', 'datetime', 'meter_id', 'populations.json', population_hash=population_hash(),
+		source_hash=source_hash, metadata_csv_path=metadata_path)
+	print("Data loading queued")
+elif not db.data_loaded() or populations_have_changed():
 	print("Loading data")
-	load_data('data/nrel/meter_time_series.csv', 'electricity_kwh', 'datetime', 'meter_id', 'populations.json')
+	load_data(source_path, 'electricity_kwh', 'datetime', 'meter_id', 'populations.json', source_hash=source_hash,
+		metadata_csv_path=metadata_path)
 	df = pd.DataFrame({'hash': population_hash()}, index=[0])
 	db.load_df(df, 'load_hash')
 
@@ -2,20 +2,116 @@
 
 import pandas as pd
 from sqlalchemy import create_engine, inspect
-from population import generate_populations
+from sqlalchemy.engine import make_url
+from population import generate_populations, precompute_private_load_shapes
+from metrics import timed
 import os 
-from time import sleep
+import hashlib
+import csv
+import threading
+from contextlib import contextmanager
+from io import StringIO
+from time import sleep, monotonic
+
+
+def copy_from_stdin(table, con, keys, data_iter):
+	""" pandas `to_sql` insertion method which streams each chunk through postgres COPY FROM STDIN. """
+	buf = StringIO()
+	csv.writer(buf).writerows(data_iter)
+	buf.seek(0)
+	columns = ', '.join(f'"{k}"' for k in keys)
+	if table.schema:
+		table_name = f'"{table.schema}"."{table.name}"'
+	else:
+		table_name = f'"{table.name}"'
+	with con.connection.cursor() as cur:
+		cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV)", buf)
+
+
+def engine_options(connection_string):
+	""" Connection pool settings, read from the environment alongside DATABASE_URL. """
+	options = {
+		'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1').lower() not in ('0', 'false', 'no'),
+		'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+	}
+	# sqlite uses a single-connection pool which takes no sizing
+	if make_url(connection_string).get_backend_name() != 'sqlite':
+		options['pool_size'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+		options['max_overflow'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+	return options
+
+
+def metadata_condition(metadata_filters):
+	""" SQL condition on meter_metadata (aliased `m`) for a population's metadata_filters: a list of
+	{column: value or [values]} mappings, e.g. [{"climate": ["1A", "3C"]}, {"efficiency": "High"}], all of which must match. """
+	clauses = []
+	for f in metadata_filters:
+		if not isinstance(f, dict):
+			raise ValueError(f"Invalid metadata filter {f!r}, expected a mapping of column to values")
+		for column, value in f.items():
+			if not column.isidentifier():
+				raise ValueError(f"Invalid metadata filter column '{column}'")
+			values = value if isinstance(value, (list, tuple)) else [value]
+			if len(values) == 0:
+				raise ValueError(f"Metadata filter on column '{column}' has no values")
+			values = ', '.join("'" + str(v).replace("'", "''") + "'" for v in values)
+			clauses.append(f"m.{column} in ({values})")
+	return ' and '.join(clauses) if clauses else '1=1'
+
 
 class DB:
+	metadata_ttl = 30
+
 	def __init__(self):		
 		connection_string = os.environ.get('DATABASE_URL', 'postgresql://edo:edo@db/edo')
 		connection_string = connection_string.replace('postgres://', 'postgresql://')
 		print(connection_string)
-		self.engine = create_engine(connection_string)
+		self.engine = create_engine(connection_string, **engine_options(connection_string))
+		self._data_version = (None, None)
+		self._catalog = (None, None)
+		self._catalog_version = (None, None)
+		self._tables = {}
+		self._local = threading.local()
 
 	def con(self):
 		con = self.engine.connect()
 		return con 
+
+	@contextmanager
+	def session(self):
+		""" Run every query issued by this thread inside the block on one pooled connection. """
+		if getattr(self._local, 'con', None) is not None:
+			yield self
+			return
+		self._local.con = self.con()
+		try:
+			yield self
+		finally:
+			self._local.con.close()
+			self._local.con = None
+
+	@contextmanager
+	def transaction(self):
+		""" Run the block in one transaction on one connection, so its writes become visible together or not at all. """
+		with self.session():
+			con = self._local.con
+			if con.in_transaction():
+				yield self
+				return
+			with con.begin():
+				yield self
+
+	@contextmanager
+	def _connection(self):
+		con = getattr(self._local, 'con', None)
+		if con is not None:
+			yield con
+			return
+		con = self.con()
+		try:
+			yield con
+		finally:
+			con.close()
 		
 
 
@@ -31,44 +127,155 @@ class DB:
 	def populations_generated(self):
 		return self.table_has_data('population')
 
+	def source_file_hash(self):
+		""" Hash of the time series CSV that meter_time_series was last ingested from, or None. """
+		if not self.table_has_data('source_file'):
+			return None
+		return self.query_df('select hash from source_file')['hash'].iloc[0]
+
+	def population_catalog(self, ttl=10):
+		""" One row per population, indexed by label, as written by generate_populations. """
+		checked_at, catalog = self._catalog
+		if checked_at is None or monotonic() - checked_at > ttl:
+			if self.table_exists('population_catalog'):
+				catalog = self.query_df('select * from population_catalog order by generated_at')
+			elif self.table_exists('population'):
+				# populations generated before the catalog existed
+				catalog = self.query_df("""
+					select population, count(distinct meter_id) as n_meters, count(*) as n_rows, 'ready' as status
+					from population group by population""")
+			else:
+				catalog = pd.DataFrame(columns=['population', 'n_meters', 'n_rows', 'generated_at', 'status', 'params_hash'])
+			catalog = catalog.set_index('population')
+			self._catalog = (monotonic(), catalog)
+		return catalog
+
+	def population_ready(self, population):
+		catalog = self.population_catalog()
+		return population in catalog.index and catalog.loc[population, 'status'] == 'ready'
+
+	def update_catalog(self, population, status, n_meters=None, n_rows=None, params_hash=None):
+		self.query("""
+			create table if not exists population_catalog (
+				population text primary key,
+				n_meters integer,
+				n_rows bigint,
+				generated_at timestamp,
+				status text,
+				params_hash text)""")
+		values = ', '.join('null' if v is None else f"'{v}'" for v in [population, n_meters, n_rows])
+		hash_value = 'null' if params_hash is None else f"'{params_hash}'"
+		self.query(f"delete from population_catalog where population='{population}'")
+		self.query(f"insert into population_catalog values ({values}, current_timestamp, '{status}', {hash_value})")
+		self.bump_catalog_version()
+		self._catalog = (None, None)
+
+	def delete_population(self, population):
+		for table in ['population', 'private_load_shapes', 'population_catalog']:
+			if self.table_exists(table):
+				self.query(f"delete from {table} where population='{population}'")
+		self.bump_catalog_version()
+		self._catalog = (None, None)
+
+	def bump_catalog_version(self):
+		# the table is never dropped, so the counter only ever increases
+		self.query('create table if not exists catalog_version (version bigint)')
+		self.query('insert into catalog_version select 0 where not exists (select 1 from catalog_version)')
+		self.query('update catalog_version set version = version + 1')
+		self._catalog_version = (None, None)
+
+	def catalog_version(self, ttl=2):
+		""" Counter bumped on every change to the population catalog, so clients can check for new or updated
+		populations with one single-row query instead of reading the catalog. """
+		checked_at, version = self._catalog_version
+		if checked_at is None or monotonic() - checked_at > ttl:
+			version = 0
+			if self.table_exists('catalog_version'):
+				version = int(self.query_df('select coalesce(max(version), 0) as version from catalog_version')['version'].iloc[0])
+			self._catalog_version = (monotonic(), version)
+		return version
+
+	def data_version(self, ttl=30):
+		""" Hash of the loaded dataset, written by data_setup.py, or None while data is (re)loading. """
+		checked_at, version = self._data_version
+		if checked_at is None or monotonic() - checked_at > ttl:
+			version = None
+			if self.table_exists('load_hash'):
+				version = self.query_df('select hash from load_hash')['hash'].iloc[0]
+			self._data_version = (monotonic(), version)
+		return version
+
 
 	def private_load_shape(self, population, quantile_cutoff, n_points, epsilon):
-		pass
+		""" Precomputed privatized load shape at the grid epsilon nearest to `epsilon`. """
+		if not self.table_exists('private_load_shapes'):
+			return None
+		where = f"population='{population}' and quantile_cutoff={quantile_cutoff} and n_points={n_points}"
+		return self.query_df(f"""
+			select * from private_load_shapes
+			where {where} and epsilon = (
+				select epsilon from private_load_shapes
+				where {where}
+				order by abs(epsilon - {epsilon})
+				limit 1)
+			order by hour""")
 
 
 	def query(self, sql):
-		con = self.con()
-		#cur = con.cursor()
-		#print(sql)
-		con.execute(sql)
-		#con.commit()
-		con.close()
+		with self._connection() as con:
+			#print(sql)
+			con.execute(sql)
+		# may have been DDL
+		self._tables.clear()
 
+	@timed('db.query_df')
 	def query_df(self, sql):
-		con = self.con()
-		#print(sql)
-		df = pd.read_sql_query(sql, con)
-		con.close()
+		with self._connection() as con:
+			#print(sql)
+			df = pd.read_sql_query(sql, con)
 		return df
 
 	def table_exists(self, table):
-		return inspect(self.engine).has_table(table)
+		checked_at, exists = self._tables.get(table, (None, None))
+		if checked_at is None or monotonic() - checked_at > self.metadata_ttl:
+			with self._connection() as con:
+				exists = inspect(con).has_table(table)
+			self._tables[table] = (monotonic(), exists)
+		return exists
 			
+	def create_index(self, table, *columns):
+		self.query(f"create index if not exists ix_{table}_{'_'.join(columns)} on {table} ({', '.join(columns)})")
+
 	def drop_table(self, table):
-		if self.table_exists(table):
-			self.query(f'drop table if exists {table}')
+		self.query(f'drop table if exists {table}')
+
+	def is_postgres(self):
+		return self.engine.dialect.name == 'postgresql'
 
-	def load_df(self, df, table_name, append=False):
+	@timed('db.load_df')
+	def load_df(self, df, table_name, append=False, copy=True, chunksize=100000):
 		if append:
 			if_exists = 'append'
 		else:
 			if_exists = 'replace'
-		con = self.con()
-		df.to_sql(table_name, con, if_exists=if_exists)
-		con.close()
+		with self._connection() as con:
+			if copy and self.is_postgres():
+				# COPY goes straight to the DBAPI cursor, so it needs an explicit transaction to be committed
+				if con.in_transaction():
+					df.to_sql(table_name, con, if_exists=if_exists, method=copy_from_stdin, chunksize=chunksize)
+				else:
+					with con.begin():
+						df.to_sql(table_name, con, if_exists=if_exists, method=copy_from_stdin, chunksize=chunksize)
+			else:
+				df.to_sql(table_name, con, if_exists=if_exists)
+		self._tables[table_name] = (monotonic(), True)
 
 
-	def meter_ids(self):
+	def meter_ids(self, metadata_filters=None):
+		if metadata_filters:
+			return self.query_df(f"""
+				select distinct meter_id from meter_metadata m where {metadata_condition(metadata_filters)}
+				and meter_id in (select meter_id from meter_time_series_daily)""")
 		return self.query_df(f"select distinct meter_id from meter_time_series")
 
 	def time_series(self, meter_id):
@@ -77,35 +284,162 @@ class DB:
 	def time_series_daily(self, meter_id):
 		return self.query_df(f"select * from meter_time_series_daily where meter_id='{meter_id}'")
 
+	def create_population_table(self):
+		self.query("create table if not exists population (population text, meter_id text, hour bigint, value double precision)")
+		self.create_index('population', 'population')
 
+	def create_private_load_shapes_table(self):
+		# the columns `privatize_population` frames are written with by `load_df`
+		self.query("""
+			create table if not exists private_load_shapes (
+				"index" bigint,
+				epsilon double precision,
+				hour double precision,
+				private_ci double precision,
+				private_mean double precision,
+				private_max double precision,
+				private_min double precision,
+				actual_mean double precision,
+				noise_added_pct double precision,
+				population text,
+				quantile_cutoff double precision,
+				n_points bigint,
+				span double precision)""")
+		self.create_index('private_load_shapes', 'population', 'n_points', 'quantile_cutoff', 'epsilon')
 
-def load_data(time_series_csv_path, value_col, datetime_col, index_col, population_json_path):
-	print(f"loading {time_series_csv_path}")
-	db_client = DB()
+	def build_daily_table(self):
+		""" Aggregate meter_time_series into hourly means inside the database (PostgreSQL only). """
+		self.query("create table meter_time_series_daily (meter_id text, hour integer, value double precision)")
+		self.query("""
+			insert into meter_time_series_daily (meter_id, hour, value)
+			select meter_id::text, extract(hour from datetime)::integer, avg(value)
+			from meter_time_series
+			group by 1, 2""")
+		self.create_index('meter_time_series_daily', 'meter_id')
+
+	def daily_matrix(self, metadata_filters=None):
+		if metadata_filters:
+			if not self.table_exists('meter_metadata'):
+				raise ValueError("metadata_filters require meter metadata to be loaded")
+			df = self.query_df(f"""
+				select d.meter_id, d.hour, d.value
+				from meter_time_series_daily d join meter_metadata m on m.meter_id = d.meter_id
+				where {metadata_condition(metadata_filters)}""")
+		else:
+			df = self.query_df("select meter_id, hour, value from meter_time_series_daily")
+		df = df.pivot(index='meter_id', columns='hour', values='value').reindex(columns=range(24))
+		return df.index.values, df.to_numpy()
+
+	def source_hash(self):
+		""" Content hash of meter_time_series_daily and meter_metadata, the data every population is sampled from. """
+		ids, values = self.daily_matrix()
+		h = hashlib.sha224()
+		h.update('\n'.join(str(i) for i in ids).encode())
+		h.update(values.round(9).tobytes())
+		if self.table_exists('meter_metadata'):
+			h.update(self.query_df('select * from meter_metadata order by meter_id').to_csv(index=False).encode())
+		return h.hexdigest()
+
+
+
+def ingest_time_series(db_client, time_series_csv_path, value_col, datetime_col, index_col, chunksize=1000000, accumulate=True):
+	""" Stream the CSV into meter_time_series in chunks, accumulating per (meter_id, hour) sums and counts
+	along the way. Returns the hourly means for meter_time_series_daily, or None if `accumulate` is False. """
+	totals = None
+	for df in pd.read_csv(time_series_csv_path, chunksize=chunksize):
+		df['value'] = df[value_col]
+		df['datetime'] = pd.to_datetime(df[datetime_col])
+		df['meter_id'] = df[index_col]
+		df = df[['meter_id', 'datetime', 'value']]
+		db_client.load_df(df, 'meter_time_series', append=True)
+		if not accumulate:
+			continue
+
+		df = df.assign(hour=df['datetime'].dt.hour)
+		chunk_totals = df.groupby(['meter_id', 'hour'])['value'].agg(['sum', 'count'])
+		if totals is None:
+			totals = chunk_totals
+		else:
+			totals = totals.add(chunk_totals, fill_value=0)
+
+	if totals is None:
+		return None
+	return (totals['sum'] / totals['count']).rename('value').reset_index()
+
+
+def load_metadata(db_client, metadata_csv_path):
+	""" Load per-meter metadata (meter_id plus attributes such as climate and efficiency) into meter_metadata,
+	indexed on every column so metadata_filters select meters with index lookups. """
+	df = pd.read_csv(metadata_csv_path, dtype=str)
+	db_client.drop_table('meter_metadata')
+	db_client.load_df(df.set_index('meter_id'), 'meter_metadata')
+	for column in df.columns:
+		db_client.create_index('meter_metadata', column)
+
+
+def file_hash(path, block_size=1 << 20):
+	h = hashlib.sha224()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def load_source(db_client, time_series_csv_path, value_col, datetime_col, index_col, chunksize=1000000, aggregate_in_db=None,
+		source_hash=None, force=False, metadata_csv_path=None):
+	""" Ingest the time series CSV into meter_time_series and meter_time_series_daily, unless it is unchanged
+	since it was last loaded (or `force`), and load the meter metadata. """
+	if aggregate_in_db is None:
+		aggregate_in_db = db_client.is_postgres()
+	if source_hash is None:
+		source_hash = file_hash(time_series_csv_path)
 
-	db_client.drop_table('meter_time_series')
-	db_client.drop_table('meter_time_series_daily')
-	db_client.drop_table('population')
 	db_client.drop_table('load_finished')
+	db_client.drop_table('load_hash')
+
+	if force or source_hash != db_client.source_file_hash() or not db_client.table_has_data('meter_time_series_daily'):
+		db_client.drop_table('source_file')
+		db_client.drop_table('meter_time_series')
+		db_client.drop_table('meter_time_series_daily')
 
-	df = pd.read_csv(time_series_csv_path)
-	df['value'] = df[value_col]
-	df['datetime'] = df[datetime_col]
-	df['meter_id'] = df[index_col]
-	df = df[['meter_id', 'datetime', 'value']]
-	db_client.load_df(df, 'meter_time_series')
+		df = ingest_time_series(db_client, time_series_csv_path, value_col, datetime_col, index_col,
+			chunksize=chunksize, accumulate=not aggregate_in_db)
+		db_client.create_index('meter_time_series', 'meter_id')
+		if aggregate_in_db:
+			db_client.build_daily_table()
+		else:
+			db_client.load_df(df, 'meter_time_series_daily')
+			db_client.create_index('meter_time_series_daily', 'meter_id')
+		db_client.load_df(pd.DataFrame({'hash': source_hash}, index=[0]), 'source_file')
 
-	df = db_client.query_df('select * from meter_time_series')
-	df['datetime'] = pd.to_datetime(df['datetime'])
-	df['hour'] = df.datetime.dt.hour
-	df = df.groupby(['meter_id', 'hour']).mean()['value'].reset_index()
-	db_client.load_df(df, 'meter_time_series_daily')
+		sleep(5)
+	else:
+		print(f"{time_series_csv_path} unchanged, skipping ingest")
 
-	sleep(5)
+	if metadata_csv_path is not None and os.path.exists(metadata_csv_path):
+		load_metadata(db_client, metadata_csv_path)
 
-	generate_populations(population_json_path, db_client)
 
+def finish_load(db_client):
 	df = pd.DataFrame({'Finished': True}, index=[0])
 	db_client.load_df(df, 'load_finished')
+
+
+def load_data(time_series_csv_path, value_col, datetime_col, index_col, population_json_path, chunksize=1000000, aggregate_in_db=None,
+		source_hash=None, force=False, metadata_csv_path=None):
+	""" Ingest the time series CSV and generate the configured populations. The ingest is skipped when the CSV
+	is unchanged since it was last loaded (unless `force`), and only new or changed populations are regenerated. """
+	print(f"loading {time_series_csv_path}")
+	db_client = DB()
+	load_source(db_client, time_series_csv_path, value_col, datetime_col, index_col, chunksize=chunksize,
+		aggregate_in_db=aggregate_in_db, source_hash=source_hash, force=force, metadata_csv_path=metadata_csv_path)
+
+	# populations are content-addressed by their config and the daily table, so unchanged ones are kept
+	labels = generate_populations(population_json_path, db_client)
+	if not db_client.table_exists('private_load_shapes'):
+		labels = None
+	precompute_private_load_shapes(db_client, labels)
+
+	finish_load(db_client)
 	print("Done")
 	return True
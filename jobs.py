@@ -0,0 +1,117 @@
+import os
+import uuid
+import pandas as pd
+from redis import Redis
+from rq import Queue, Retry, get_current_job
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from database import DB, load_source, finish_load
+from population import plan_populations, generate_population, precompute_population
+import logging
+logger = logging.getLogger(__name__)
+
+
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 6*60*60))
+JOB_RETRIES = int(os.environ.get('JOB_RETRIES', 2))
+# job ids are scoped to one load, so status lookups never find the jobs of an earlier one
+CURRENT_LOAD_KEY = 'edo:current_load'
+
+
+def job_queue(connection=None, is_async=True, name='default'):
+	""" The queue data loading jobs go through, on REDIS_URL unless a connection is given; None if neither is.
+	With `is_async=False` jobs run in-process as they are enqueued (e.g. on a fakeredis connection, in tests). """
+	if connection is None:
+		redis_url = os.environ.get('REDIS_URL')
+		if redis_url is None:
+			return None
+		connection = Redis.from_url(redis_url)
+	return Queue(name, connection=connection, is_async=is_async)
+
+
+def enqueue(queue, func, *args, job_id, depends_on=None, **kwargs):
+	# jobs enqueue their follow-up jobs on the queue they came from, so they need to know if it runs synchronously
+	return queue.enqueue(func, *args, job_id=job_id, depends_on=depends_on, job_timeout=JOB_TIMEOUT,
+		retry=Retry(max=JOB_RETRIES, interval=[60, 300]) if JOB_RETRIES else None,
+		meta={'is_async': queue.is_async}, **kwargs)
+
+
+def current_queue():
+	job = get_current_job()
+	return Queue(job.origin, connection=job.connection, is_async=job.meta.get('is_async', True))
+
+
+def enqueue_load(queue, time_series_csv_path, value_col, datetime_col, index_col, population_json_path,
+		population_hash=None, **load_kwargs):
+	""" Queue the equivalent of `load_data` as separate jobs: the ingest, then one job per population to generate,
+	each followed by its grid precompute, then a final job marking the load finished (and recording
+	`population_hash` as the data version). Returns the ingest job. """
+	load_id = uuid.uuid4().hex[:12]
+	queue.connection.set(CURRENT_LOAD_KEY, load_id)
+	ingest = enqueue(queue, ingest_job, args=(time_series_csv_path, value_col, datetime_col, index_col), kwargs=load_kwargs,
+		job_id=f"load:{load_id}:ingest")
+	enqueue(queue, schedule_populations_job, load_id, population_json_path, population_hash,
+		job_id=f"load:{load_id}:schedule", depends_on=ingest)
+	return ingest
+
+
+def ingest_job(time_series_csv_path, value_col, datetime_col, index_col, **load_kwargs):
+	logger.info(f"loading {time_series_csv_path}")
+	load_source(DB(), time_series_csv_path, value_col, datetime_col, index_col, **load_kwargs)
+
+
+def schedule_populations_job(load_id, population_json_path, population_hash=None):
+	db_client = DB()
+	queue = current_queue()
+	todo = plan_populations(population_json_path, db_client)
+	labels = [config['label'] for config, key in todo]
+	if not db_client.table_exists('private_load_shapes'):
+		labels = list(db_client.population_catalog(ttl=0).index)
+	# created here rather than by the first precompute job, so parallel jobs don't race to create it
+	db_client.create_private_load_shapes_table()
+
+	generate_jobs = {}
+	for config, key in todo:
+		label = config['label']
+		generate_jobs[label] = enqueue(queue, generate_population_job, config, key, job_id=f"generate:{load_id}:{label}")
+	precompute_jobs = [
+		enqueue(queue, precompute_population_job, label, job_id=f"precompute:{load_id}:{label}", depends_on=generate_jobs.get(label))
+		for label in labels
+		]
+	enqueue(queue, finish_load_job, population_hash, job_id=f"load:{load_id}:finish", depends_on=precompute_jobs or None)
+
+
+def generate_population_job(config, key):
+	job = get_current_job()
+
+	def progress(done, total):
+		job.meta['progress'] = done / total
+		job.save_meta()
+	generate_population((config, key), db_client=DB(), progress=progress)
+
+
+def precompute_population_job(label):
+	precompute_population(DB(), label)
+
+
+def finish_load_job(population_hash=None):
+	db_client = DB()
+	finish_load(db_client)
+	if population_hash is not None:
+		db_client.load_df(pd.DataFrame({'hash': population_hash}, index=[0]), 'load_hash')
+	logger.info("Done")
+
+
+def population_progress(queue, labels):
+	""" Status and fraction of meters written of the generation job, in the latest load, of each of `labels` that has one. """
+	progress = {}
+	load_id = queue.connection.get(CURRENT_LOAD_KEY)
+	if load_id is None:
+		return progress
+	load_id = load_id.decode()
+	for label in labels:
+		try:
+			job = Job.fetch(f"generate:{load_id}:{label}", connection=queue.connection)
+		except NoSuchJobError:
+			continue
+		progress[label] = {'status': job.get_status(), 'progress': job.meta.get('progress')}
+	return progress
@@ -0,0 +1,131 @@
+import os
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import flask
+
+
+# spans are only recorded with METRICS_ENABLED=1 in the environment when this module is imported;
+# otherwise `timed` returns functions unchanged and `span` is a shared no-op context
+ENABLED = os.environ.get("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+
+# upper bounds, in seconds, of the histogram buckets (the Prometheus client defaults)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_NULL_SPAN = nullcontext({})
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextmanager
+def _span(name, labels):
+    start = perf_counter()
+    try:
+        yield labels
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+
+def span(name, **labels):
+    """ Time the block into the `name` histogram. The labels dict is yielded, so the block can add to it
+    (e.g. whether it was a cache hit) before the time is recorded. """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _span(name, labels)
+
+
+def timed(name):
+    """ Decorator timing every call of the function into the `name` histogram. """
+
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, perf_counter() - start)
+
+        return wrapper
+
+    return decorate
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def _format_labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+def prometheus_text():
+    """ All span histograms, plus the persistent cache counters, in the Prometheus text exposition format. """
+    from cache import Cacheable
+
+    lines = [
+        "# HELP edo_span_seconds Time spent in instrumented code paths.",
+        "# TYPE edo_span_seconds histogram",
+    ]
+    with _lock:
+        histograms = sorted(
+            (name, labels, list(h.counts), h.sum, h.count)
+            for (name, labels), h in _histograms.items()
+        )
+    for name, labels, counts, total, count in histograms:
+        labels = _format_labels((("span", name),) + labels)
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += n
+            lines.append(f'edo_span_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"edo_span_seconds_sum{{{labels}}} {total}")
+        lines.append(f"edo_span_seconds_count{{{labels}}} {count}")
+
+    lines += [
+        "# HELP edo_cache_events_total Persistent cache lookups and failures.",
+        "# TYPE edo_cache_events_total counter",
+    ]
+    for event, n in sorted(Cacheable.stats.items()):
+        lines.append(f'edo_cache_events_total{{event="{event}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+def register_endpoint(server, path="/metrics"):
+    """ Serve `prometheus_text` at `path` on the Flask `server`. """
+
+    def metrics():
+        return flask.Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+    server.add_url_rule(path, "metrics", metrics)
@@ -1,7 +1,11 @@
+import os
+import hashlib
+from multiprocessing import Pool
 import pandas as pd
 import simplejson as json 
 import numpy as np
 from privacy import PrivateLoadShape
+from population_store import PopulationStore
 import logging
 logger = logging.getLogger(__name__)
 
@@ -16,49 +20,231 @@ import flask
 
 import plotly.express as px
 import plotly.graph_objs as go
-from cache import Cacheable
+from cache import Cacheable, MemoryCache
+
+
+# process-wide cache of loaded populations, shared by every PlottingPopulation
+population_cache = MemoryCache(max_bytes=int(os.environ.get('POPULATION_CACHE_BYTES', 1024**3)))
+
+# file-based alternative to the population table, used for generation when POPULATION_STORE=arrow
+population_store = PopulationStore()
+
+N_POINTS_CHOICES = [1, 2, 4, 8, 12, 24]
+QUANTILE_CUTOFF_CHOICES = [0, 0.01, 0.02, 0.03, 0.04, 0.05]
+# epsilons precomputed into private_load_shapes, ~6% apart
+EPSILON_GRID = np.logspace(-1, 3, 161)
+# labels of populations generated in memory on demand, followed by their JSON config
+ADHOC_PREFIX = 'adhoc:'
+# largest ad-hoc population, which is held in memory as a (meters x 24) matrix
+ADHOC_MAX_METERS = int(os.environ.get('ADHOC_MAX_METERS', 100000))
+# scaling of ad-hoc populations which don't give one
+DEFAULT_ADHOC_SCALING = {'lognormal_mean': 1.5, 'lognormal_sigma': 0.6, 'gaussian_mean': 0.0, 'gaussian_sigma': 1.0}
+SCALING_FIELDS = ['lognormal_mean', 'lognormal_sigma', 'gaussian_mean', 'gaussian_sigma']
+
+
+def resample(values, n_points):
+	""" Average the columns of a (meters x 24) matrix down to `n_points` equal periods, ignoring missing readings. """
+	blocks = values.reshape(len(values), n_points, values.shape[1] // n_points)
+	present = np.isfinite(blocks)
+	with np.errstate(invalid='ignore'):
+		return np.where(present, blocks, 0).sum(axis=2, dtype=float) / present.sum(axis=2)
+
+
+def build_load_shape(meter_ids, values, high_outlier, n_points, quantile_cutoff):
+	""" Build a PrivateLoadShape from a population's (meters x 24) matrix. """
+	if high_outlier:
+		# one extra meter carrying 20% of the whole population's load
+		meter_ids = np.append(meter_ids, 'high_outlier')
+		values = np.vstack([values, np.nansum(values, axis=0, dtype=float) * 0.20])
+	return PrivateLoadShape.from_matrix(resample(values, n_points), meter_ids, time_index=np.arange(n_points, dtype=float),
+			index_column='meter_id', time_column='hour', value_column='value',
+			quantile_cutoff_lower=0, quantile_cutoff_upper=1-quantile_cutoff)
+
+
+def use_population_store():
+	return os.environ.get('POPULATION_STORE', 'sql') == 'arrow'
+
+
+def load_population_matrix(db_client, label):
+	""" (meter_ids, values) of a population as a (meters x 24) matrix, from the population store if it holds
+	the population, else the population table. """
+	if population_store.exists(label):
+		return population_store.read(label)
+	df = db_client.query_df(f"select meter_id, hour, value from population where population='{label}'")
+	df = df.pivot(index='meter_id', columns='hour', values='value').reindex(columns=range(24))
+	return df.index.values, df.to_numpy()
+
+
+def adhoc_label(n_meters, scaling=None, random_seed=1, rescale=True, metadata_filters=None):
+	""" Label of an ad-hoc population: one synthesized in memory from the source data on demand, which is
+	never written to the database and lives only in the population cache. Raises ValueError for a configuration
+	that could not be synthesized. """
+	from database import metadata_condition
+	if not 1 <= int(n_meters) <= ADHOC_MAX_METERS:
+		raise ValueError(f"Ad-hoc populations have 1 to {ADHOC_MAX_METERS} meters, not {n_meters}")
+	if scaling is None:
+		scaling = DEFAULT_ADHOC_SCALING if rescale else {}
+	scaling = {f: float(v) for f, v in scaling.items()}
+	if rescale:
+		for f in SCALING_FIELDS:
+			if not f in scaling.keys():
+				raise ValueError(f"Population param 'scaling' must contain field '{f}'")
+		if not (scaling['lognormal_sigma'] >= 0 and scaling['gaussian_sigma'] >= 0):
+			raise ValueError("Population scaling sigmas must not be negative")
+	metadata_filters = metadata_filters or []
+	metadata_condition(metadata_filters)
+	config = {
+		'n_meters': int(n_meters),
+		'rescale': bool(rescale),
+		'scaling': scaling,
+		'random_seed': int(random_seed),
+		'metadata_filters': metadata_filters,
+		}
+	return ADHOC_PREFIX + json.dumps(config, sort_keys=True, separators=(',', ':'))
+
+
+def adhoc_config(label):
+	""" Config of an ad-hoc population label, or None if `label` is not a valid one. Labels come from the client,
+	so they are only accepted if `adhoc_label` builds the very same label from their config. """
+	if isinstance(label, str) and label.startswith(ADHOC_PREFIX):
+		try:
+			config = json.loads(label[len(ADHOC_PREFIX):])
+			if adhoc_label(**config) == label:
+				return config
+		except (ValueError, TypeError, AttributeError):
+			pass
+	return None
+
+
+def source_matrix(db_client, metadata_filters=None):
+	""" (meter_ids, values) of meter_time_series_daily, held in the population cache. """
+	version = db_client.data_version()
+	if version is None:
+		return db_client.daily_matrix(metadata_filters)
+	key = ('source', version, json.dumps(metadata_filters or [], sort_keys=True))
+	return population_cache.get(key, lambda: db_client.daily_matrix(metadata_filters))
+
+
+def adhoc_population_matrix(db_client, label):
+	""" (meter_ids, values) of an ad-hoc population, synthesized from the cached source matrix. """
+	config = adhoc_config(label)
+	pop = Population(db_client, label, config['rescale'], config['n_meters'], config['scaling'],
+		random_seed=config['random_seed'], metadata_filters=config['metadata_filters'])
+	source_ids, values = pop.sample(*source_matrix(db_client, pop.metadata_filters))
+	return pop.meter_labels(source_ids), values
 
 
 class Population:
-	def __init__(self, db_client, label, rescale, n_meters, scaling, random_seed=1):
+	def __init__(self, db_client, label, rescale, n_meters, scaling, random_seed=1, store=None, metadata_filters=None):
 		self.label = label
 		self.db_client = db_client
+		self.store = store
 		self.rescale = rescale
 		self.n_meters = int(n_meters)
 		self.scaling = scaling 
+		self.metadata_filters = metadata_filters or []
+		# an independent stream per population, so populations sharing a random_seed still differ
+		label_key = int(hashlib.sha224(str(label).encode()).hexdigest()[:16], 16)
+		self.rng = np.random.default_rng(np.random.SeedSequence(int(random_seed or 0), spawn_key=(label_key,)))
 		if self.rescale:
-			for f in ['lognormal_mean', 'lognormal_sigma', 'gaussian_mean', 'gaussian_sigma']:
+			for f in SCALING_FIELDS:
 				if not f in self.scaling.keys():
 					raise ValueError(f"Population param 'scaling' must contain field '{f}'")
 		
 
 
-	def generate(self):		
+	def generate(self, bulk=True, batch_size=5000, progress=None):
+		if bulk or self.store is not None:
+			return self.generate_bulk(batch_size=batch_size, progress=progress)
 		i = 0
+		n_rows = 0
 		logger.info("Generating meter population")
-		meter_ids = self.db_client.meter_ids()
-		output_meter_ids = meter_ids.sample(self.n_meters, replace=True)
-		for m in output_meter_ids.meter_id.values:
-			df = self.db_client.time_series_daily(m)
+		meter_ids = self.db_client.meter_ids(self.metadata_filters).meter_id.values
+		if len(meter_ids) == 0:
+			raise ValueError(f"No meters match the metadata_filters of population {self.label}")
+		output_meter_ids = meter_ids[self.rng.integers(0, len(meter_ids), size=self.n_meters)]
+		for m in output_meter_ids:
+			df = self.db_client.time_series_daily(m)[['meter_id', 'hour', 'value']]
 			df = self.transform(df)
 			df['meter_id'] = str(i) + "_" + df['meter_id']
 			df['population'] = self.label
 			i = i+1
 			df = df.set_index(['population', 'meter_id', 'hour'])
 			self.db_client.load_df(df, 'population', append=True)
+			n_rows += len(df)
+		return n_rows
+
+	def generate_bulk(self, batch_size=5000, progress=None):
+		""" Generate the population from a single (meters x 24) read of meter_time_series_daily,
+		writing it to the population store if there is one, else to the population table in batches
+		of `batch_size` meters. `progress`, if given, is called with (meters written, n_meters)
+		after each batch. Returns the number of rows written. """
+		logger.info("Generating meter population (bulk)")
+		source_ids, values = self.sample(*self.db_client.daily_matrix(self.metadata_filters))
+		if self.store is not None:
+			self.store.write(self.label, self.meter_labels(source_ids), values)
+			if progress is not None:
+				progress(self.n_meters, self.n_meters)
+			return int(np.isfinite(values).sum())
+		n_rows = 0
+		for start in range(0, self.n_meters, batch_size):
+			stop = min(start + batch_size, self.n_meters)
+			df = self.population_frame(source_ids[start:stop], values[start:stop], offset=start)
+			self.db_client.load_df(df, 'population', append=True)
+			n_rows += len(df)
+			logger.info(f"{self.label}: wrote {stop} of {self.n_meters} meters")
+			if progress is not None:
+				progress(stop, self.n_meters)
+		return n_rows
+
+	def sample(self, source_ids, source_values):
+		""" Draw the population's meters from the (meters x 24) source matrix and transform them.
+		Returns the source meter id and the transformed values of each drawn meter. """
+		if len(source_ids) == 0:
+			raise ValueError(f"No meters match the metadata_filters of population {self.label}")
+		rows = self.rng.integers(0, len(source_ids), size=self.n_meters)
+		return source_ids[rows], self.transform_matrix(source_values[rows])
+
+	def meter_labels(self, source_ids, offset=0):
+		return (pd.Series(np.arange(offset, offset + len(source_ids))).astype(str) + "_" + pd.Series(source_ids).astype(str)).values
+
+	def population_frame(self, source_ids, values, offset=0):
+		n, k = values.shape
+		df = pd.DataFrame({
+			'population': self.label,
+			'meter_id': np.repeat(self.meter_labels(source_ids, offset), k),
+			'hour': np.tile(np.arange(k), n),
+			'value': values.ravel()
+			})
+		df = df.dropna(subset=['value'])
+		return df.set_index(['population', 'meter_id', 'hour'])
 
 	def transform(self, df):
 		if self.rescale:
 			df['value'] = df['value'] / df['value'].max()
-			noise = np.random.normal(loc=self.scaling['gaussian_mean'],
+			noise = self.rng.normal(loc=self.scaling['gaussian_mean'],
 								scale=self.scaling['gaussian_sigma'],
 								size=len(df))
 			df['value'] = df['value'] + noise
-			factor = np.random.lognormal(mean=self.scaling['lognormal_mean'],
+			factor = self.rng.lognormal(mean=self.scaling['lognormal_mean'],
 								sigma=self.scaling['lognormal_sigma'])
 			df['value'] = df['value'] * factor
 		return df
 
+	def transform_matrix(self, values):
+		""" Whole-array equivalent of `transform`, one row per meter. """
+		if self.rescale:
+			values = values / np.nanmax(values, axis=1, keepdims=True)
+			noise = self.rng.normal(loc=self.scaling['gaussian_mean'],
+								scale=self.scaling['gaussian_sigma'],
+								size=values.shape)
+			values = values + noise
+			factor = self.rng.lognormal(mean=self.scaling['lognormal_mean'],
+								sigma=self.scaling['lognormal_sigma'],
+								size=(len(values), 1))
+			values = values * factor
+		return values
+
 
 # class BuiltPopulation:
 
@@ -93,48 +279,81 @@ class PlottingPopulation(Cacheable):
 		self.high_outlier = high_outlier 
 		self.n_points = n_points
 		self.quantile_cutoff = quantile_cutoff 
+		self.adhoc = adhoc_config(population)
+		self.cache_version = self.content_version()
 		super().__init__()
 
+	def content_version(self):
+		""" Version the population's caches are keyed on: its content address from the catalog, so a ready population
+		stays cached while others are (re)generated, or None while it is not ready and may still change. """
+		if self.adhoc is not None:
+			# synthesized from the whole source data, which is only versioned once a load has finished
+			return self.db_client.data_version()
+		catalog = self.db_client.population_catalog()
+		if self.population not in catalog.index or catalog.loc[self.population, 'status'] != 'ready':
+			return None
+		key = catalog.loc[self.population].get('params_hash')
+		if key is None or pd.isnull(key):
+			# populations generated before they were content-addressed
+			return self.db_client.data_version()
+		return key
+
+	def cache_key(self):
+		return (self.cache_version, self.population, bool(self.high_outlier), self.n_points, self.quantile_cutoff)
+
 	def load_shape(self):
+		cached = population_cache.peek(self.cache_key())
+		if cached is not None:
+			return cached
 		if not self.ready():
 			return None
 
 		def get():
-			df = self.db_client.query_df(f"select * from population where population='{self.population}'")
-
-			if self.high_outlier:
-				total_load_shape = df.groupby(['hour']).sum()
-				total_usage = total_load_shape.value.sum()
-				new_load_shape = (total_load_shape*0.20).reset_index() 
-				new_load_shape['meter_id'] = 'high_outlier'
-				new_load_shape['population'] = self.population
-				new_load_shape['index'] = None
-				df = pd.concat([df, new_load_shape[['population', 'meter_id', 'hour', 'index', 'value']]])			
-
-			df['hour'] = df['hour'] // (24/self.n_points)
-			df = df.groupby(['population','meter_id','hour']).mean().reset_index()		
-			return PrivateLoadShape(df, index_column='meter_id', time_column='hour', value_column='value', 
-					quantile_cutoff_lower=0, quantile_cutoff_upper=1-self.quantile_cutoff)
-		return self.cache_func(get, self.make_cache_key([self.population, self.high_outlier, self.n_points, self.quantile_cutoff]))
+			meter_ids, values = self.population_matrix()
+			return build_load_shape(meter_ids, values, self.high_outlier, self.n_points, self.quantile_cutoff)
+		if self.cache_version is None:
+			# the population is still being (re)generated
+			return get()
+		if self.adhoc is not None:
+			# ad-hoc populations are only ever held in memory
+			return population_cache.get(self.cache_key(), get)
+		return population_cache.get(self.cache_key(),
+			lambda: self.cache_func(get, self.make_cache_key([self.population, self.high_outlier, self.n_points, self.quantile_cutoff]),
+				cls=PrivateLoadShape))
+
+	def population_matrix(self):
+		""" The population's (meters x 24) matrix, loaded once and shared by every n_points, cutoff and outlier setting. """
+		def get():
+			if self.adhoc is not None:
+				return adhoc_population_matrix(self.db_client, self.population)
+			return load_population_matrix(self.db_client, self.population)
+		if self.cache_version is None:
+			return get()
+		return population_cache.get(('matrix', self.cache_version, self.population), get)
+
+	def private_load_shape(self, epsilon):
+		""" Privatized load shape at `epsilon`, served from the nearest point of the precomputed grid when available. """
+		if self.adhoc is None and not self.high_outlier and EPSILON_GRID[0] <= epsilon <= EPSILON_GRID[-1]:
+			df = self.db_client.private_load_shape(self.population, self.quantile_cutoff, self.n_points, epsilon)
+			if df is not None and len(df) > 0:
+				return df
+		return self.load_shape().privatize(epsilon)
 
 	def avg_usage_by_meter(self):
 		if not self.ready():
 			return ""
 
-		df = self.load_shape().df 
-		return df.groupby('meter_id').value.mean().reset_index()
-		#return self.load_shape().mean_usage()
+		return self.load_shape().usage_by_meter.reset_index()
 
 
 	def avg_usage(self):
 		return self.avg_usage_by_meter().value.mean()
 
 	def ready(self):
-		try:
-			self.db_client.query_df(f"select count(*) from population where population='{self.population}'")
-			return True 
-		except Exception as e:
-			return False
+		if self.adhoc is not None:
+			# synthesized from the source data, so ready as soon as that is loaded
+			return self.cache_version is not None or self.db_client.table_exists('meter_time_series_daily')
+		return self.db_client.population_ready(self.population)
 
 
 	def find_epsilon(self, uncertainty):
@@ -151,14 +370,9 @@ class PlottingPopulation(Cacheable):
 		if not self.ready():
 			return None
 		ls = self.load_shape()
-		mean_usage = ls.mean_usage()        
-		out = []
-		for noise in np.linspace(0.01,1,100):
-			ci = mean_usage * noise 
-			epsilon = ls.epsilon_for_confidence_interval(ci)
-			out.append(pd.Series({'noise_pct': noise, 'epsilon': epsilon}))
-
-		return pd.DataFrame(out)
+		noise = np.linspace(0.01,1,100)
+		epsilon = ls.epsilons_for_confidence_intervals(ls.mean_usage() * noise)
+		return pd.DataFrame({'noise_pct': noise, 'epsilon': epsilon})
 
 	def fifteen_fifteen(self):
 		if not self.ready(): 
@@ -194,22 +408,12 @@ class PlottingPopulation(Cacheable):
 		
 		try:
 			if self.ready():
-				df = self.avg_usage_by_meter()
-				fig = px.histogram(df, x="value")
+				fig = usage_histogram_figure(usage_histogram(self.avg_usage_by_meter()['value']))
 			else:
-				fig = go.Figure()
-		except Exception as e:
-			print(e)
-			fig = go.Figure()
-		fig.update_layout(
-			yaxis_title='value',
-			title='Mean usage histogram',
-			hovermode="x",
-			showlegend=False,
-			height=250,
-			#width=320,
-			margin=dict(t=50)
-		)  
+				fig = usage_histogram_figure(None)
+		except Exception:
+			logger.exception(f"Could not build the usage histogram of population {self.population}")
+			fig = usage_histogram_figure(None)
 		return fig
 
 
@@ -217,8 +421,13 @@ class PlottingPopulation(Cacheable):
 		if not self.ready():
 			return ""
 
-		df = self.avg_usage_by_meter()
-		return len(df)
+		if self.adhoc is not None:
+			n_meters = self.adhoc['n_meters']
+		else:
+			n_meters = self.db_client.population_catalog().loc[self.population, 'n_meters']
+		if self.high_outlier:
+			n_meters += 1
+		return int(n_meters)
 
 
 
@@ -226,25 +435,35 @@ class PlottingPopulation(Cacheable):
 
 		try:
 			if self.ready():
-				df = self.epsilon_uncertainty_mapping()
-				df = df[df['noise_pct'] <= 0.50]
-				df['noise_added (%)'] = df['noise_pct'] * 100
-				df['privacy_factor'] = df['epsilon']
-				fig = px.line(df, x='noise_added (%)', y='privacy_factor')
+				fig = epsilon_noise_figure(self.epsilon_uncertainty_mapping())
 			else:
-				fig = go.Figure()
-		except Exception as e:
-			print(e)
-			fig = go.Figure()
-		fig.update_layout(            
-			title='Noise/privacy tradeoff',
-			hovermode="x",
-			showlegend=False,
-			height=250,
-			#width=320,
-			margin=dict(t=50)
-		)  
+				fig = epsilon_noise_figure(None)
+		except Exception:
+			logger.exception(f"Could not build the epsilon/noise curve of population {self.population}")
+			fig = epsilon_noise_figure(None)
 		return fig 
+
+	def summary(self, n_points=None):
+		""" Everything the population diagnostics display, computed together so that one input change
+		costs one load. The epsilon curve uses `n_points` (default: this population's). Values are
+		JSON-serializable, for a dcc.Store. """
+		if not self.ready():
+			return {'ready': False}
+		usage = self.avg_usage_by_meter()['value']
+		if n_points is None or n_points == self.n_points:
+			curve = self.epsilon_uncertainty_mapping()
+		else:
+			curve = PlottingPopulation(self.db_client, self.population, self.high_outlier, n_points=n_points,
+				quantile_cutoff=self.quantile_cutoff).epsilon_uncertainty_mapping()
+		fifteen_fifteen = self.fifteen_fifteen()
+		return {
+			'ready': True,
+			'n_meters': self.n_meters(),
+			'avg_usage': float(usage.mean()),
+			'fifteen_fifteen': fifteen_fifteen,
+			'histogram': usage_histogram(usage),
+			'epsilon_curve': {'noise_pct': curve['noise_pct'].tolist(), 'epsilon': curve['epsilon'].tolist()},
+		}
   
 	def graph_load_shape(self, epsilon):
 		try:
@@ -263,9 +482,6 @@ class PlottingPopulation(Cacheable):
 			else: 
 				mode = "lines"
 
-			ls = self.load_shape()
-			#epsilon=5
-			
 			if epsilon is None:
 				fig = go.Figure()
 				fig.update_layout(
@@ -276,7 +492,7 @@ class PlottingPopulation(Cacheable):
 				)    
 				return fig
 				
-			df = ls.privatize(epsilon)
+			df = self.private_load_shape(epsilon)
 			#import pdb; pdb.set_trace()
 			fig = go.Figure([
 			go.Scatter(
@@ -332,42 +548,214 @@ class PlottingPopulation(Cacheable):
 
 
 
-# 	def privatize_and_aggregate(self):
-# #		quantile_cutoffs = [0,0.1,0.2,0.3,0.4,0.5]
-# 		#points = [1,2,4,8,12,18,24]
-# 		for n_points in [2,8,12,18,24]:				
-# 			df = self.get()
-# 			df = self.resample_hours(df, n_points)
-# 			for quantile_cutoff in [0,0.01, 0.02, 0.03, 0.04, 0.05]:
-# 				for epsilon in np.logspace(start=-0.5, stop=2,num=100):
-# 					ls = PrivateLoadShape(df, index_column='meter_id', time_column='hour', value_column='value', 
-# 						quantile_cutoff_lower=0, quantile_cutoff_upper=1-quantile_cutoff)
-# 					df_aggregated = ls.privatize(epsilon=epsilon)
-# 					df_aggregated['population'] = self.label
-# 					df_aggregated['epsilon'] = epsilon
-# 					df_aggregated['quantile_cutoff'] = quantile_cutoff
-# 					df_aggregated['n_points'] = n_points
-# 					df_aggregated['span'] = (df_aggregated['private_max'] - df_aggregated['private_mean']) / df_aggregated['private_mean']
-					
-# 					self.db_client.load_df(df_aggregated, 'private_load_shapes', append=True)
-
-
-
-
-def generate_populations(populations_json_path, db_client):
-	db_client.drop_table('population')	
+def adhoc_load_shape(db_client, n_meters, scaling=None, random_seed=1, rescale=True, metadata_filters=None,
+		high_outlier=False, n_points=24, quantile_cutoff=0):
+	""" PrivateLoadShape of a population synthesized in memory with the given parameters, without writing it
+	to the database. Repeated calls with the same parameters are served from the population cache. """
+	label = adhoc_label(n_meters, scaling=scaling, random_seed=random_seed, rescale=rescale, metadata_filters=metadata_filters)
+	return PlottingPopulation(db_client, label, high_outlier, n_points=n_points, quantile_cutoff=quantile_cutoff).load_shape()
+
+
+def usage_histogram(usage, max_bins=100):
+	bins = min(len(np.histogram_bin_edges(usage, bins='auto')) - 1, max_bins)
+	counts, edges = np.histogram(usage, bins=bins)
+	return {'counts': counts.tolist(), 'edges': edges.tolist()}
+
+
+def usage_histogram_figure(histogram):
+	""" Mean usage histogram from the output of `usage_histogram`, or an empty figure for None. """
+	if histogram is None:
+		fig = go.Figure()
+	else:
+		edges = np.asarray(histogram['edges'])
+		fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=histogram['counts'], width=np.diff(edges)))
+	fig.update_layout(
+		xaxis_title='Mean hourly usage',
+		yaxis_title='Number of meters',
+		title='Mean usage histogram',
+		hovermode="x",
+		showlegend=False,
+		height=250,
+		#width=320,
+		margin=dict(t=50)
+	)  
+	return fig
+
+
+def epsilon_noise_figure(curve):
+	""" Noise/privacy tradeoff from a noise_pct/epsilon mapping, or an empty figure for None. """
+	if curve is None:
+		fig = go.Figure()
+	else:
+		df = pd.DataFrame(curve)
+		df = df[df['noise_pct'] <= 0.50]
+		df['noise_added (%)'] = df['noise_pct'] * 100
+		df['privacy_factor'] = df['epsilon']
+		fig = px.line(df, x='noise_added (%)', y='privacy_factor')
+	fig.update_layout(            
+		title='Noise/privacy tradeoff',
+		hovermode="x",
+		showlegend=False,
+		height=250,
+		#width=320,
+		margin=dict(t=50)
+	)  
+	return fig 
+
+
+_worker_db = None
+
+
+def _init_worker(db_class):
+	global _worker_db
+	_worker_db = db_class()
+	# forked workers inherit the parent's random state; give each its own noise
+	np.random.seed()
+
+
+def privatize_population(label, db_client=None):
+	""" Privatized load shapes of one population for every n_points, quantile cutoff and grid epsilon. """
+	logger.info(f"Privatizing population: {label}")
+	meter_ids, values = load_population_matrix(db_client or _worker_db, label)
+	# seeded from the OS rather than the random state a forked pool or job worker inherits, so no two
+	# populations' releases share their noise
+	rng = np.random.default_rng()
+	out = []
+	for n_points in N_POINTS_CHOICES:
+		for quantile_cutoff in QUANTILE_CUTOFF_CHOICES:
+			ls = build_load_shape(meter_ids, values, False, n_points, quantile_cutoff)
+			df_aggregated = ls.privatize_many(EPSILON_GRID, rng=rng)
+			df_aggregated['population'] = label
+			df_aggregated['quantile_cutoff'] = quantile_cutoff
+			df_aggregated['n_points'] = n_points
+			df_aggregated['span'] = (df_aggregated['private_max'] - df_aggregated['private_mean']) / df_aggregated['private_mean']
+			out.append(df_aggregated)
+	logger.info(f"Finished privatizing population: {label}")
+	return pd.concat(out, ignore_index=True)
+
+
+def precompute_private_load_shapes(db_client, labels=None, processes=None):
+	""" Fill the private_load_shapes table for `labels` (default all populations, replacing the table),
+	privatizing populations in parallel worker processes. """
+	if labels is None:
+		db_client.drop_table('private_load_shapes')
+		labels = db_client.population_catalog(ttl=0).index.values
+	elif db_client.table_exists('private_load_shapes'):
+		for label in labels:
+			db_client.query(f"delete from private_load_shapes where population='{label}'")
+	if len(labels) == 0:
+		return
+	if processes is None:
+		processes = int(os.environ.get('PRECOMPUTE_WORKERS', os.cpu_count() or 1))
+	with Pool(processes, initializer=_init_worker, initargs=(type(db_client),)) as pool:
+		for df in pool.imap_unordered(privatize_population, labels):
+			db_client.load_df(df, 'private_load_shapes', append=True)
+	db_client.create_index('private_load_shapes', 'population', 'n_points', 'quantile_cutoff', 'epsilon')
+
+
+def precompute_population(db_client, label):
+	""" Replace the private_load_shapes rows of one population, in the calling process. """
+	df = privatize_population(label, db_client)
+	db_client.create_private_load_shapes_table()
+	with db_client.transaction():
+		db_client.query(f"delete from private_load_shapes where population='{label}'")
+		db_client.load_df(df, 'private_load_shapes', append=True)
+
+
+def params_hash(config):
+	""" Stable hash of one population's configuration. """
+	return hashlib.sha224(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def population_key(config, source_hash):
+	""" Content address of a generated population: its configuration (including random_seed) and the source data. """
+	return params_hash({'config': config, 'source': source_hash})
+
+
+def generate_population(args, db_client=None, progress=None):
+	""" Generate one population, by default in a pool worker process. Its rows and its 'ready' catalog entry
+	are committed in one transaction, so readers never see a partial population; if generation fails the
+	population is marked 'failed'. """
+	config, key = args
+	label = config['label']
+	db_client = db_client or _worker_db
+	logger.info(f"Processing population: {label}")
+	db_client.update_catalog(label, 'generating', params_hash=key)
+	try:
+		generate_population_rows(db_client, config, key, progress)
+	except Exception:
+		db_client.update_catalog(label, 'failed', params_hash=key)
+		raise
+	logger.info(f"Finished processing population: {label}")
+	return label
+
+
+def generate_population_rows(db_client, config, key, progress=None):
+	label = config['label']
+	pop = Population(
+		db_client = db_client,
+		label = label,
+		rescale = config['rescale'],
+		n_meters = config['n_meters'],
+		scaling = config['scaling'],
+		random_seed = config.get('random_seed'),
+		store = population_store if use_population_store() else None,
+		metadata_filters = config.get('metadata_filters')
+		)
+	if pop.store is None:
+		population_store.delete(label)
+	with db_client.transaction():
+		db_client.query(f"delete from population where population='{label}'")
+		# the old version's precomputed load shapes must not be served for the new rows
+		if db_client.table_exists('private_load_shapes'):
+			db_client.query(f"delete from private_load_shapes where population='{label}'")
+		n_rows = pop.generate(progress=progress)
+		db_client.update_catalog(label, 'ready', n_meters=pop.n_meters, n_rows=n_rows, params_hash=key)
+
+
+def plan_populations(populations_json_path, db_client):
+	""" Compare the configured populations with the catalog: drop populations no longer configured, and mark
+	those which are new or whose configuration or source data changed as 'queued'. Returns (config, key)
+	for each population to generate. """
 	settings = json.load(open(populations_json_path))
-	for p in settings['populations']:	
-		logger.info(f"Processing population: {p['label']}")		
-		pop = Population(
-			db_client = db_client,
-			label = p['label'],
-			rescale = p['rescale'],
-			n_meters = p['n_meters'],
-			scaling = p['scaling'],
-			random_seed = ['random_seed']
-			)
-		pop.generate()	
-		#pop.privatize_and_aggregate()
-		logger.info(f"Finished processing population: {p['label']}")		
-		
\ No newline at end of file
+	source_hash = db_client.source_hash()
+	keys = {p['label']: population_key(p, source_hash) for p in settings['populations']}
+
+	db_client.create_population_table()
+	catalog = db_client.population_catalog(ttl=0)
+	for label in catalog.index:
+		if label not in keys:
+			logger.info(f"Dropping population: {label}")
+			db_client.delete_population(label)
+			population_store.delete(label)
+
+	todo = []
+	for p in settings['populations']:
+		label = p['label']
+		if label in catalog.index and catalog.loc[label, 'status'] == 'ready' and catalog.loc[label].get('params_hash') == keys[label]:
+			logger.info(f"Population unchanged, skipping: {label}")
+			continue
+		db_client.update_catalog(label, 'queued', params_hash=keys[label])
+		todo.append((p, keys[label]))
+	return todo
+
+
+def generate_populations(populations_json_path, db_client, processes=None):
+	""" Bring the generated populations in line with `populations_json_path`, in a pool of worker processes.
+	Populations whose configuration and source data are unchanged since they were generated are kept as they are,
+	and populations no longer configured are dropped. Returns the labels that were (re)generated. """
+	todo = plan_populations(populations_json_path, db_client)
+	if not todo:
+		return []
+
+	if processes is None:
+		processes = int(os.environ.get('GENERATE_WORKERS', os.cpu_count() or 1))
+	if not db_client.is_postgres():
+		# sqlite allows a single writer at a time
+		processes = 1
+	generated = []
+	with Pool(processes, initializer=_init_worker, initargs=(type(db_client),)) as pool:
+		for label in pool.imap_unordered(generate_population, todo):
+			generated.append(label)
+			logger.info(f"Generated {len(generated)} of {len(todo)} populations (latest: {label})")
+	return generated
@@ -0,0 +1,79 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PopulationStore:
+	""" Populations stored as one Arrow IPC file each under `data_dir`, as an alternative to the
+	long-form population table.
+
+	Each file holds a `meter_id` column and a `values` column of fixed-size float32 lists, one per meter,
+	so the (meters x 24) matrix is a single contiguous buffer which is memory-mapped and read without copying.
+	"""
+
+	def __init__(self, data_dir=None):
+		if data_dir is None:
+			data_dir = os.environ.get('POPULATION_STORE_DIR', os.path.join('data', 'populations'))
+		self.data_dir = data_dir
+
+	def path(self, label):
+		return os.path.join(self.data_dir, f"{label}.arrow")
+
+	def exists(self, label):
+		return os.path.exists(self.path(label))
+
+	def labels(self):
+		if not os.path.exists(self.data_dir):
+			return []
+		return [f[:-len('.arrow')] for f in sorted(os.listdir(self.data_dir)) if f.endswith('.arrow')]
+
+	def write(self, label, meter_ids, values):
+		values = np.ascontiguousarray(values, dtype=np.float32)
+		n, k = values.shape
+		table = pa.table({
+			'meter_id': pa.array(np.asarray(meter_ids).astype(str)),
+			'values': pa.FixedSizeListArray.from_arrays(pa.array(values.ravel()), k),
+			})
+		os.makedirs(self.data_dir, exist_ok=True)
+		# write beside the target and rename, so readers only ever see complete files
+		tmp = f"{self.path(label)}.{os.getpid()}.tmp"
+		with pa.OSFile(tmp, 'wb') as sink:
+			with pa.ipc.new_file(sink, table.schema) as writer:
+				writer.write_table(table)
+		os.replace(tmp, self.path(label))
+		logger.info(f"Stored population {label}: {n} meters")
+
+	def read(self, label):
+		""" Returns (meter_ids, values), with `values` a read-only (meters x k) float32 view of the mapped file. """
+		with pa.memory_map(self.path(label), 'r') as source:
+			table = pa.ipc.open_file(source).read_all()
+		column = table.column('values')
+		column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+		k = column.type.list_size
+		values = column.flatten().to_numpy(zero_copy_only=True).reshape(-1, k)
+		meter_ids = table.column('meter_id').to_numpy()
+		return meter_ids, values
+
+	def read_df(self, label):
+		""" The population in the long form of the population table. """
+		meter_ids, values = self.read(label)
+		n, k = values.shape
+		df = pd.DataFrame({
+			'population': label,
+			'meter_id': np.repeat(meter_ids, k),
+			'hour': np.tile(np.arange(k), n),
+			'value': values.ravel().astype(float)
+			})
+		return df.dropna(subset=['value']).reset_index(drop=True)
+
+	def delete(self, label):
+		if self.exists(label):
+			os.remove(self.path(label))
+
+	def clear(self):
+		if os.path.exists(self.data_dir):
+			shutil.rmtree(self.data_dir)
@@ -1,4 +1,5 @@
 import pandas as pd 
+from metrics import timed
 import eeprivacy
 from eeprivacy.mechanisms import *
 from eeprivacy.operations import *
@@ -12,57 +13,200 @@ class PrivateVector:
         self.upper_bound = upper_bound 
         self.confidence = confidence
         self.gaussian = PrivateVectorClampedMeanGaussian(lower_bound=lower_bound, upper_bound=upper_bound, k=self.k, N=self.n)
+        # neither depends on epsilon, so compute them once
+        self._actual_means = np.mean(values, 0)
+        self._clamped_means = np.sum(np.clip(values, lower_bound, upper_bound), 0) / self.n
 
     def actual_means(self):
-        return np.mean(self.values, 0)
+        return self._actual_means
 
     def private_means(self, epsilon):
-        return self.gaussian.execute(vectors=self.values, epsilon=epsilon, delta=1/(self.n**2))
+        return self.private_means_many([epsilon])[0]
+
+    def private_means_many(self, epsilons, rng=None):
+        """ Gaussian-mechanism means for each of `epsilons`, stacked as a (len(epsilons) x k) array.
+        Equivalent to calling `PrivateVectorClampedMeanGaussian.execute` once per epsilon. The noise comes from
+        `rng`, a numpy Generator, or the global `np.random` state if none is given. """
+        epsilons = np.asarray(epsilons, dtype=float)
+        scale = GaussianMechanism.scale(sensitivity=self.private_sensitivity(), epsilon=epsilons, delta=1/(self.n**2))
+        rng = rng or np.random
+        return self._clamped_means + rng.normal(0, 1, size=(len(epsilons), self.k)) * scale[:, np.newaxis]
 
     def private_ci(self, epsilon):
         return self.gaussian.confidence_interval(epsilon=epsilon, delta=1/(self.n**2), confidence=self.confidence)
 
+    def private_cis(self, epsilons):
+        return GaussianMechanism.confidence_interval(epsilon=np.asarray(epsilons, dtype=float), delta=1/(self.n**2),
+            sensitivity=self.private_sensitivity(), confidence=self.confidence)
+
     def private_sensitivity(self):
         return self.gaussian.sensitivity
 
     def epsilon_for_confidence_interval(self, target_ci, delta=None, confidence=0.95):
+        return self.epsilons_for_confidence_intervals([target_ci], delta=delta, confidence=confidence)[0]
+
+    def epsilons_for_confidence_intervals(self, target_cis, delta=None, confidence=0.95):
+        """ Epsilon for each of an array of target confidence intervals, using the closed-form Gaussian mechanism relation. """
         if delta is None:
             delta = 1/(self.n**2)
-        return self.gaussian.epsilon_for_confidence_interval(target_ci=target_ci, delta=delta, confidence=confidence)
+        return GaussianMechanism.epsilon_for_confidence_interval(target_ci=np.asarray(target_cis, dtype=float),
+            sensitivity=self.private_sensitivity(), delta=delta, confidence=confidence)
 
     
-    def private_trials(self, epsilon, n=100000):
-        trials = [] 
-        means = self.private_means()
-        for i in range(n):
-          # compute monte carlo simulation, for use later on
-          trials.append(GaussianMechanism.execute_batch(
-            values=means, 
-            epsilon=epsilon,
-            delta=1/(self.n**2),
-            sensitivity=self.private_sensitivity()
-        ))
-        return trials
-      
+    def private_trials(self, epsilon, n=100000, quantiles=(0.025, 0.5, 0.975), chunk_size=10000, seed=None,
+            return_trials=False, bins=4096):
+        """ Monte Carlo simulation of the Gaussian mechanism at `epsilon`.
+
+        Draws `n` releases of the k-vector mean in (chunk_size x k) blocks from a seeded Generator, so memory
+        stays bounded for any `n`. Returns a frame with one row per element: the exact (clamped) mean, the
+        requested quantiles of the releases and the fraction of releases inside the analytic +/- `private_ci`.
+        Quantiles come from a `bins`-bin histogram over +/-8 sigma, accurate to 16/bins sigma; pass
+        `return_trials=True` to get exact quantiles and the raw (n x k) trials as well.
+        """
+        rng = np.random.default_rng(seed)
+        means = self._clamped_means
+        scale = GaussianMechanism.scale(sensitivity=self.private_sensitivity(), epsilon=epsilon, delta=1/(self.n**2))
+        ci = self.private_ci(epsilon)
+        lo = means - 8 * scale
+        width = 16 * scale / bins
+        counts = np.zeros((self.k, bins), dtype=np.int64)
+        covered = np.zeros(self.k, dtype=np.int64)
+        trials = []
+        for start in range(0, n, chunk_size):
+            chunk = means + rng.standard_normal((min(chunk_size, n - start), self.k)) * scale
+            covered += (np.abs(chunk - means) <= ci).sum(0)
+            if return_trials:
+                trials.append(chunk)
+                continue
+            idx = np.clip(((chunk - lo) / width).astype(np.int64), 0, bins - 1)
+            counts += np.bincount((idx + np.arange(self.k) * bins).ravel(), minlength=self.k * bins).reshape(self.k, bins)
+
+        summary = pd.DataFrame({'exact_mean': means, 'coverage': covered / n})
+        if return_trials:
+            trials = np.concatenate(trials)
+            values = np.quantile(trials, quantiles, axis=0)
+        else:
+            # interpolate each element's empirical CDF between bin edges
+            cdf = np.concatenate([np.zeros((self.k, 1)), np.cumsum(counts, 1) / n], 1)
+            edges = np.arange(bins + 1) * width
+            values = np.array([[lo[j] + np.interp(q, cdf[j], edges) for j in range(self.k)] for q in quantiles])
+        for q, value in zip(quantiles, values):
+            summary[q] = value
+        if return_trials:
+            return summary, trials
+        return summary
+
 
 class PrivateLoadShape(PrivateVector):
+    @timed('PrivateLoadShape.__init__')
     def __init__(self, df, index_column, time_column, value_column, quantile_cutoff_lower=0.02, quantile_cutoff_upper=0.98, confidence=0.95):
-        self.lower_bound = df[value_column].quantile(quantile_cutoff_lower)
-        self.upper_bound = df[value_column].quantile(quantile_cutoff_upper)
-        df = df[df[value_column] >= self.lower_bound]
-        df = df[df[value_column] <= self.upper_bound]
-        self.df = df
-        self.time_index = df[time_column].drop_duplicates()
+        df_wide = df.pivot(index=index_column, columns=time_column, values=value_column)
+        self._init_matrix(df_wide.to_numpy(dtype=float), df_wide.index.values, df_wide.columns.values,
+            quantile_cutoff_lower, quantile_cutoff_upper, confidence, index_column, time_column, value_column)
+
+    @classmethod
+    @timed('PrivateLoadShape.from_matrix')
+    def from_matrix(cls, values, meter_ids=None, time_index=None, quantile_cutoff_lower=0.02, quantile_cutoff_upper=0.98, confidence=0.95,
+            index_column='meter_id', time_column='hour', value_column='value'):
+        """ Build a load shape from a (meters x k) array, one row per meter with NaN for missing readings,
+        without going through a long-form frame. """
+        values = np.asarray(values, dtype=float)
+        if meter_ids is None:
+            meter_ids = np.arange(len(values))
+        if time_index is None:
+            time_index = np.arange(values.shape[1])
+        ls = cls.__new__(cls)
+        ls._init_matrix(values, np.asarray(meter_ids), np.asarray(time_index), quantile_cutoff_lower, quantile_cutoff_upper,
+            confidence, index_column, time_column, value_column)
+        return ls
+
+    @classmethod
+    def from_chunks(cls, chunks, n_meters=None, **kwargs):
+        """ Build a load shape from an iterable of (meter_ids, values) chunks, each as for `from_matrix`.
+        The chunks are copied into one (meters x k) buffer as they arrive, allocated for `n_meters` rows when the
+        total is known and otherwise grown in place, so chunks are not held alongside the full matrix. """
+        meter_ids, values, n = [], None, 0
+        for chunk_ids, chunk_values in chunks:
+            chunk_values = np.asarray(chunk_values, dtype=float)
+            if values is None:
+                values = np.empty((n_meters or len(chunk_values), chunk_values.shape[1]))
+            if n + len(chunk_values) > len(values):
+                # realloc, which for large buffers remaps pages rather than copying them
+                values.resize((max(2 * len(values), n + len(chunk_values)), values.shape[1]), refcheck=False)
+            values[n:n + len(chunk_values)] = chunk_values
+            n += len(chunk_values)
+            # ids are one value per meter, small next to the readings
+            meter_ids.append(np.asarray(chunk_ids))
+        if values is None:
+            raise ValueError("No chunks to build a load shape from")
+        if n < len(values):
+            values.resize((n, values.shape[1]), refcheck=False)
+        return cls.from_matrix(values, np.concatenate(meter_ids), **kwargs)
+
+    def _init_matrix(self, values, meter_ids, time_index, quantile_cutoff_lower, quantile_cutoff_upper, confidence,
+            index_column, time_column, value_column):
+        # the quantiles of all readings, as over the long form; overwrite_input lets np.quantile partition the copy in place
+        finite = np.isfinite(values)
+        self.lower_bound, self.upper_bound = np.quantile(values[finite], [quantile_cutoff_lower, quantile_cutoff_upper],
+            overwrite_input=True)
+        keep = finite & (values >= self.lower_bound) & (values <= self.upper_bound)
         self.index_column = index_column
         self.value_column = value_column
         self.time_column = time_column
-        self.df_wide = self.df.pivot(index=self.index_column, columns=self.time_column, values=self.value_column).dropna().to_numpy()
+        counts = keep.sum(axis=1)
+        sums = np.where(keep, values, 0).sum(axis=1)
+        # meters without any reading inside the bounds drop out, as do readings outside them
+        has_usage = counts > 0
+        self.usage_by_meter = pd.Series(sums[has_usage] / counts[has_usage], name=value_column,
+            index=pd.Index(meter_ids[has_usage], name=index_column))
+        self._mean_usage = sums.sum() / counts.sum()
+        complete = keep.all(axis=1)
+        self.time_index = pd.Series(time_index, name=time_column)
+        self.df_wide = values if complete.all() else values[complete]
         self.n = len(self.df_wide)
         super().__init__(values=self.df_wide, lower_bound=self.lower_bound, upper_bound=self.upper_bound, confidence=confidence)
                 
 
+    @property
+    def nbytes(self):
+        return self.df_wide.nbytes + self.usage_by_meter.memory_usage(deep=True) + self.time_index.memory_usage(deep=True)
+
     def mean_usage(self):
-        return self.df[self.value_column].mean()  
+        return self._mean_usage
+
+    def to_arrays(self):
+        arrays = {
+            'values': np.asarray(self.df_wide),
+            'time_index': np.asarray(self.time_index),
+            'meter_ids': self.usage_by_meter.index.values.astype(str),
+            'meter_usage': self.usage_by_meter.values,
+        }
+        meta = {
+            'lower_bound': float(self.lower_bound),
+            'upper_bound': float(self.upper_bound),
+            'confidence': self.confidence,
+            'mean_usage': float(self._mean_usage),
+            'index_column': self.index_column,
+            'time_column': self.time_column,
+            'value_column': self.value_column,
+        }
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        """ Rebuild a load shape from the output of `to_arrays`, without recomputing clipping or pivots. """
+        ls = cls.__new__(cls)
+        ls.index_column = meta['index_column']
+        ls.time_column = meta['time_column']
+        ls.value_column = meta['value_column']
+        ls._mean_usage = meta['mean_usage']
+        ls.time_index = pd.Series(arrays['time_index'], name=ls.time_column)
+        ls.usage_by_meter = pd.Series(arrays['meter_usage'], name=ls.value_column,
+            index=pd.Index(arrays['meter_ids'], name=ls.index_column))
+        ls.df_wide = arrays['values']
+        PrivateVector.__init__(ls, values=ls.df_wide, lower_bound=meta['lower_bound'], upper_bound=meta['upper_bound'],
+            confidence=meta['confidence'])
+        return ls
 
 
     # def noise_epsilon_mapping(self):
@@ -79,16 +223,24 @@ class PrivateLoadShape(PrivateVector):
     #         return df[df.noise_pct >= noise_pct].sort_values('noise_pct', ascending=True)['epsilon'].iloc[0]
             
 
-    def privatize(self, epsilon):        
-        means = self.private_means(epsilon)
+    def privatize(self, epsilon):
+        return self.privatize_many([epsilon]).drop(columns='epsilon')
+
+    @timed('PrivateLoadShape.privatize_many')
+    def privatize_many(self, epsilons, rng=None):
+        """ Privatized load shapes for each of `epsilons`, stacked into one long frame with an `epsilon` column. """
+        epsilons = np.asarray(epsilons, dtype=float)
+        m = len(epsilons)
+        means = self.private_means_many(epsilons, rng=rng).ravel()
+        ci = np.repeat(self.private_cis(epsilons), self.k)
+        actual_means = np.tile(self.actual_means(), m)
         return pd.DataFrame({
-            self.time_column: self.time_index,            
-            'private_ci': self.private_ci(epsilon),
+            'epsilon': np.repeat(epsilons, self.k),
+            self.time_column: np.tile(self.time_index.values, m),
+            'private_ci': ci,
             'private_mean': means,
-            'private_max': means + self.private_ci(epsilon),
-            'private_min': means - self.private_ci(epsilon),
-            'actual_mean': self.actual_means(),
-            'noise_added_pct':  (abs(self.private_ci(epsilon))) / self.actual_means()
-            }).sort_values(self.time_column)
-
-
+            'private_max': means + ci,
+            'private_min': means - ci,
+            'actual_mean': actual_means,
+            'noise_added_pct': abs(ci) / actual_means
+            })
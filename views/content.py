@@ -6,7 +6,13 @@ import plotly.graph_objects as go
 import pandas as pd
 import dash_uploader as du 
 import uuid 
+import os
 from .nav import nav
+from population import ADHOC_MAX_METERS
+
+
+# how often the page checks for new populations; the check is one single-row query unless something changed
+POLL_INTERVAL_MS = int(float(os.environ.get('POPULATION_POLL_SECONDS', 5)) * 1000)
 
 societal_value_choices = [{
     'label': 'Low',
@@ -40,6 +46,7 @@ def content_layout(logos):
         [
         nav("/load-shape"),
         dcc.Store(id='data_store'),
+        dcc.Store(id='catalog_version'),
             html.Div([
 
                 html.H2("Population selection"),
@@ -57,6 +64,21 @@ def content_layout(logos):
                                     options=[],    
                                     clearable=False,
                                     value=" (loading) ", className="padded")], id="prebuilt_population_container"),                            
+
+                            html.Div(id='load_status'),
+
+                            html.Details([
+                                html.Summary("Custom population", className="padded"),
+                                html.Div([
+                                    html.Div("Number of meters", className="padded"),
+                                    dcc.Input(id='adhoc_n_meters', type='number', min=1, max=ADHOC_MAX_METERS, step=1, value=10000, className="padded"),
+                                    html.Div("Usage spread (lognormal sigma)", className="padded"),
+                                    dcc.Input(id='adhoc_sigma', type='number', min=0, step=0.1, value=0.6, className="padded"),
+                                    html.Div("Random seed", className="padded"),
+                                    dcc.Input(id='adhoc_seed', type='number', min=0, step=1, value=1, className="padded"),
+                                    html.Button("Add", id='adhoc_add', n_clicks=0, className="padded"),
+                                ])
+                            ], id="adhoc_population_container"),
                                                      
                             html.Div([                       
                                 html.Div([
@@ -182,7 +204,7 @@ def content_layout(logos):
 
 
                 ], style={'width': '100%', 'pading': '10px'}),
-                dcc.Interval(id='trigger', interval=60*60*24*1000)
+                dcc.Interval(id='trigger', interval=POLL_INTERVAL_MS)
             ], className="six columns inputsContainer")
         # html.Div([
         #     html.Img(src=logos[0], width=200),
@@ -0,0 +1,15 @@
+import os
+import logging
+import redis
+from rq import Worker, Queue, Connection
+
+listen = ['default']
+redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+conn = redis.from_url(redis_url)
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	with Connection(conn):
+		worker = Worker(map(Queue, listen))
+		# failed jobs are retried after a delay, which goes through the scheduler
+		worker.work(with_scheduler=True)